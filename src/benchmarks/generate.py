@@ -0,0 +1,284 @@
+"""
+Synthetic TD /transactions payload generator.
+
+Produces realistic-looking transaction histories: single-leg options
+trades that are later closed, multi-leg orders (spreads), equity trades,
+option assignments and the odd non-trade transaction (dividends, cash
+transfers), spread over many symbols.
+
+Run from the src directory:
+
+    python -m benchmarks.generate 100000 > transactions.json
+"""
+import sys
+import json
+import random
+import argparse
+import datetime
+
+
+TICKERS = (
+    'AAPL', 'AMD', 'AMZN', 'BA', 'BABA', 'BAC', 'CHPT', 'CRM', 'DIS', 'F',
+    'FB', 'GE', 'GME', 'GOOG', 'INTC', 'JPM', 'KO', 'MSFT', 'MU', 'NFLX',
+    'NIO', 'NVDA', 'PFE', 'PLTR', 'PYPL', 'QQQ', 'SNAP', 'SPY', 'SQ', 'T',
+    'TSLA', 'UBER', 'UUUU', 'V', 'WMT', 'XOM',
+)
+
+
+def _symbols(count):
+    symbols = list(TICKERS[:count])
+    i = 0
+    while len(symbols) < count:
+        symbols.append(f'SYM{i}')
+        i += 1
+    return symbols
+
+
+def _td_datetime(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+
+def _next_friday(date, weeks):
+    date += datetime.timedelta(weeks=weeks)
+    return date + datetime.timedelta(days=(4 - date.weekday()) % 7)
+
+
+class _Generator:
+    def __init__(self, seed, num_symbols, start):
+        self.rand = random.Random(seed)
+        self.symbols = _symbols(num_symbols)
+        self.prices = {s: self.rand.uniform(5, 500) for s in self.symbols}
+        self.now = start
+        self.transaction_id = 30000000000
+        self.order_id = 4000000000
+        self.open_positions = []
+
+    def _fees(self, option):
+        return {
+            'rFee': 0.0,
+            'additionalFee': 0.0,
+            'cdscFee': 0.0,
+            'regFee': round(self.rand.uniform(0, 0.05), 2),
+            'otherCharges': 0.0,
+            'commission': 0.65 if option else 0.0,
+            'optRegFee': 0.02 if option else 0.0,
+            'secFee': 0.0,
+        }
+
+    def _transaction(self, ttype, item, description, net_amount,
+                     subtype='BO', order_id=None):
+        self.transaction_id += 1
+        settlement = self.now.date() + datetime.timedelta(days=1)
+        txn = {
+            'type': ttype,
+            'subAccount': '2',
+            'settlementDate': settlement.isoformat(),
+            'netAmount': round(net_amount, 2),
+            'transactionDate': _td_datetime(self.now),
+            'transactionSubType': subtype,
+            'transactionId': self.transaction_id,
+            'cashBalanceEffectFlag': True,
+            'description': description,
+            'fees': self._fees(item is not None and
+                               item['instrument']['assetType'] == 'OPTION'),
+        }
+        if order_id is not None:
+            txn['orderId'] = f'T{order_id}'
+            txn['orderDate'] = _td_datetime(
+                self.now - datetime.timedelta(seconds=self.rand.randint(0, 5)))
+        if item is not None:
+            txn['transactionItem'] = item
+        else:
+            txn['transactionItem'] = {'accountId': 123456789}
+        return txn
+
+    def _option_item(self, option, instruction, effect, quantity, price):
+        symbol, expiration, put_call, strike = option
+        option_symbol = (f'{symbol}_{expiration:%m%d%y}{put_call[0]}'
+                         f'{strike}')
+        sign = -1 if instruction == 'BUY' else 1
+        return {
+            'accountId': 123456789,
+            'amount': float(quantity),
+            'price': price,
+            'cost': round(sign * price * quantity * 100, 2),
+            'instruction': instruction,
+            'positionEffect': effect,
+            'instrument': {
+                'symbol': option_symbol,
+                'underlyingSymbol': symbol,
+                'optionExpirationDate': _td_datetime(datetime.datetime(
+                    expiration.year, expiration.month, expiration.day, 5)),
+                'putCall': put_call,
+                'cusip': f'0{symbol[:4]}.{put_call[0]}{strike}',
+                'description': f'{symbol} {expiration} {strike} {put_call}',
+                'assetType': 'OPTION',
+            },
+        }
+
+    def _equity_item(self, symbol, instruction, quantity, price):
+        sign = -1 if instruction == 'BUY' else 1
+        return {
+            'accountId': 123456789,
+            'amount': float(quantity),
+            'price': price,
+            'cost': round(sign * price * quantity, 2),
+            'instruction': instruction,
+            'instrument': {
+                'symbol': symbol,
+                'cusip': f'{symbol[:6]:>6}101',
+                'assetType': 'EQUITY',
+            },
+        }
+
+    def _new_option(self, symbol):
+        underlying = self.prices[symbol]
+        strike = max(1, int(underlying * self.rand.uniform(0.8, 1.2)))
+        expiration = _next_friday(self.now.date(), self.rand.randint(0, 8))
+        return (symbol, expiration, self.rand.choice(('CALL', 'PUT')), strike)
+
+    def _trade(self, option, instruction, effect, quantity, order_id):
+        price = round(self.rand.uniform(0.05, 15), 2)
+        item = self._option_item(option, instruction, effect, quantity,
+                                 price)
+        net = item['cost']
+        return self._transaction('TRADE', item, f'{instruction} TRADE', net,
+                                 order_id=order_id)
+
+    def single_leg(self):
+        self.order_id += 1
+        if self.open_positions and self.rand.random() < 0.45:
+            option, instruction, quantity = self.open_positions.pop(
+                self.rand.randrange(len(self.open_positions)))
+            closing = 'SELL' if instruction == 'BUY' else 'BUY'
+            return [self._trade(option, closing, 'CLOSING', quantity,
+                                self.order_id)]
+        option = self._new_option(self.rand.choice(self.symbols))
+        instruction = self.rand.choice(('BUY', 'SELL'))
+        quantity = self.rand.choice((1, 1, 1, 2, 3, 5, 10))
+        self.open_positions.append((option, instruction, quantity))
+        return [self._trade(option, instruction, 'OPENING', quantity,
+                            self.order_id)]
+
+    def multi_leg(self):
+        self.order_id += 1
+        symbol, expiration, put_call, strike = self._new_option(
+            self.rand.choice(self.symbols))
+        quantity = self.rand.choice((1, 2, 5))
+        legs = []
+        for i in range(self.rand.randint(2, 4)):
+            option = (symbol, expiration, put_call, strike + i)
+            instruction = 'SELL' if i % 2 else 'BUY'
+            legs.append(self._trade(option, instruction, 'OPENING', quantity,
+                                    self.order_id))
+            self.open_positions.append((option, instruction, quantity))
+        return legs
+
+    def equity(self):
+        self.order_id += 1
+        symbol = self.rand.choice(self.symbols)
+        instruction = self.rand.choice(('BUY', 'SELL'))
+        quantity = self.rand.choice((1, 10, 50, 100))
+        price = round(self.prices[symbol], 2)
+        item = self._equity_item(symbol, instruction, quantity, price)
+        return [self._transaction('TRADE', item, f'{instruction} TRADE',
+                                  item['cost'], order_id=self.order_id)]
+
+    def assignment(self):
+        shorts = [p for p in self.open_positions if p[1] == 'SELL']
+        if not shorts:
+            return self.single_leg()
+        self.order_id += 1
+        position = self.rand.choice(shorts)
+        self.open_positions.remove(position)
+        (symbol, expiration, put_call, strike), _, quantity = position
+        removal = self._option_item(position[0], 'BUY', 'CLOSING', quantity,
+                                    0.0)
+        removal.pop('instruction')
+        # Assigned puts deliver shares to us, assigned calls take them away
+        instruction = 'BUY' if put_call == 'PUT' else 'SELL'
+        stock = self._equity_item(symbol, instruction, quantity * 100,
+                                  float(strike))
+        return [
+            self._transaction('RECEIVE_AND_DELIVER', removal,
+                              'REMOVAL OF OPTION DUE TO ASSIGNMENT', 0.0,
+                              subtype='OA'),
+            self._transaction('TRADE', stock,
+                              f'{instruction} TRADE (OPTION ASSIGNMENT)',
+                              stock['cost'], subtype='OA',
+                              order_id=self.order_id),
+        ]
+
+    def non_trade(self):
+        if self.rand.random() < 0.5:
+            return [self._transaction(
+                'DIVIDEND_OR_INTEREST', None, 'FREE BALANCE INTEREST',
+                round(self.rand.uniform(0.01, 5), 2), subtype='FI')]
+        return [self._transaction(
+            'ELECTRONIC_FUND', None, 'CLIENT REQUESTED ELECTRONIC FUNDING',
+            round(self.rand.uniform(100, 5000), 2), subtype='CI')]
+
+    def step(self):
+        self.now += datetime.timedelta(
+            seconds=self.rand.randint(60, 6 * 60 * 60))
+        for symbol in self.symbols:
+            if self.rand.random() < 0.05:
+                self.prices[symbol] *= self.rand.uniform(0.95, 1.05)
+        kind = self.rand.random()
+        if kind < 0.70:
+            return self.single_leg()
+        if kind < 0.85:
+            return self.multi_leg()
+        if kind < 0.90:
+            return self.equity()
+        if kind < 0.95:
+            return self.assignment()
+        return self.non_trade()
+
+
+def iter_transactions(count, seed=0, num_symbols=50,
+                      start=datetime.datetime(2019, 1, 2, 14, 30)):
+    """
+    Yields count synthetic TD transactions, oldest first.
+    """
+    generator = _Generator(seed, num_symbols, start)
+    produced = 0
+    while produced < count:
+        for txn in generator.step()[:count - produced]:
+            produced += 1
+            yield txn
+
+
+def generate_transactions(count, seed=0, num_symbols=50):
+    """
+    Returns a list of count synthetic TD transactions, newest first (like
+    the TD API).
+    """
+    return list(iter_transactions(count, seed, num_symbols))[::-1]
+
+
+def write_transactions(f, count, seed=0, num_symbols=50):
+    """
+    Writes count synthetic transactions to f as a JSON array, one element
+    at a time.
+    """
+    f.write('[')
+    for i, txn in enumerate(iter_transactions(count, seed, num_symbols)):
+        f.write(',\n' if i else '\n')
+        f.write(json.dumps(txn))
+    f.write('\n]\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('count', type=int,
+                        help="Number of transactions to generate")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--symbols', type=int, default=50,
+                        help="Number of distinct underlying symbols")
+    args = parser.parse_args()
+    write_transactions(sys.stdout, args.count, args.seed, args.symbols)
+
+
+if __name__ == "__main__":
+    main()
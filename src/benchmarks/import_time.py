@@ -0,0 +1,83 @@
+"""
+Import-time budget check for cheap thetactl subcommands.
+
+Runs each command under ``python -X importtime`` and fails if the total
+import time goes over budget or if any of the heavy dependencies that
+only analyze-options needs got imported.
+
+Run from the src directory:
+
+    python -m benchmarks.import_time
+"""
+import os
+import sys
+import subprocess
+
+
+# Total self time of all imports, in milliseconds. -X importtime adds some
+# overhead of its own, so this is looser than the real startup cost.
+IMPORT_BUDGET_MS = 75
+
+# Modules that must not be imported by cheap subcommands
+HEAVY_MODULES = (
+    'dateparser',
+    'tabulate',
+    'requests',
+    'dateutil',
+    'pytz',
+    'tzlocal',
+    'thetalib.brokers',
+)
+
+CHEAP_COMMANDS = (
+    ['--help'],
+    ['list-brokers'],
+)
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_imports(argv):
+    """
+    Returns (total_ms, modules) for running thetactl.py with argv, where
+    modules is the set of imported module names.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', 'thetactl.py', *argv],
+        cwd=SRC_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    total_us = 0
+    modules = set()
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        total_us += int(self_us)
+        modules.add(name.strip())
+    return total_us / 1000, modules
+
+
+def main():
+    failed = False
+    for argv in CHEAP_COMMANDS:
+        total_ms, modules = measure_imports(argv)
+        heavy = sorted(
+            m for m in modules
+            if any(m == h or m.startswith(h + '.') for h in HEAVY_MODULES)
+        )
+        ok = total_ms <= IMPORT_BUDGET_MS and not heavy
+        failed = failed or not ok
+        print(f"{'ok  ' if ok else 'FAIL'} thetactl.py {' '.join(argv)}: "
+              f"{total_ms:.1f} ms of imports (budget {IMPORT_BUDGET_MS} ms)")
+        for m in heavy:
+            print(f"       imported heavy module {m}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+End-to-end benchmark of the analyze-options pipeline on synthetic TD
+transaction histories (see benchmarks.generate).
+
+Every stage is timed separately, at each size, and the results are
+written as JSON so that runs from different commits can be compared.
+
+Run from the src directory:
+
+    python -m benchmarks.suite --output before.json
+    (change things)
+    python -m benchmarks.suite --output after.json --compare before.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from benchmarks.generate import write_transactions
+from thetalib.aggregate import profit_totals
+from thetalib.brokers import TradeTable
+from thetalib.brokers.base import parallel_parse
+from thetalib.brokers.providers.td import (
+    BrokerTd,
+    TdTrade,
+    parse_td_trades,
+)
+from thetalib.jsonstream import iter_json_array
+from thetalib.ledger import iter_symbol_ledgers
+from thetalib.ui.components import (
+    _get_trade_grid,
+    _get_trade_sequence,
+    trade_grid,
+)
+
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _best_time(fn, setup, repeat):
+    best = None
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        fn(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class _Fixture:
+    """
+    Inputs shared by the stages of a single size.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path) as f:
+            self.raw = list(iter_json_array(f))
+        self.td_trades = [TdTrade(t) for t in self.raw
+                          if t['type'] == 'TRADE']
+        broker = self.loaded_broker()
+        self.options_trades = broker.get_options_trades()
+        self.ledgers = list(iter_symbol_ledgers(self.options_trades))
+        self.symbols = [ledger.symbol for ledger in self.ledgers[:5]]
+
+    def broker(self):
+        broker = BrokerTd.from_config({
+            'name': 'bench',
+            'provider': 'td',
+            'data': {'file': self.path},
+        })
+        # Keep the file's index with it in the temporary directory, rather
+        # than leaving one behind in the user data dir on every run
+        broker.archive_dir = os.path.dirname(self.path)
+        return broker
+
+    def uncached_broker(self):
+        # Without the trades cached by earlier loads, so it parses them all
+        broker = self.broker()
+        try:
+            os.unlink(broker._get_raw_archive().cache_path)
+        except FileNotFoundError:
+            pass
+        return broker
+
+    def cached_broker(self):
+        # A fresh broker, with the trades cached by a load before it
+        self.loaded_broker()
+        return self.broker()
+
+    def loaded_broker(self):
+        broker = self.broker()
+        broker.provider_get_trades()
+        return broker
+
+    def warm_broker(self):
+        broker = self.loaded_broker()
+        broker.get_trades()
+        return broker
+
+
+def _decode(path):
+    with open(path) as f:
+        return list(iter_json_array(f))
+
+
+# (name, setup(fixture) -> arg, fn(fixture, arg))
+STAGES = (
+    ('json_decode',
+     lambda fx: fx.path,
+     lambda fx, path: _decode(path)),
+    ('tdtrade',
+     lambda fx: fx.raw,
+     lambda fx, raw: [TdTrade(t) for t in raw if t['type'] == 'TRADE']),
+    ('trade_table',
+     lambda fx: fx.td_trades,
+     lambda fx, trades: TradeTable.from_trades(trades)),
+    ('parallel_parse',
+     lambda fx: [t for t in fx.raw if t['type'] == 'TRADE'],
+     lambda fx, raw: parallel_parse(parse_td_trades, raw)),
+    ('broker_load',
+     lambda fx: fx.uncached_broker(),
+     lambda fx, broker: broker.provider_get_trades()),
+    ('broker_load_cached',
+     lambda fx: fx.cached_broker(),
+     lambda fx, broker: broker.provider_get_trades()),
+    ('get_trades_cold',
+     lambda fx: fx.loaded_broker(),
+     lambda fx, broker: broker.get_trades()),
+    ('get_trades_filtered',
+     lambda fx: fx.warm_broker(),
+     lambda fx, broker: broker.get_trades(
+         symbols=fx.symbols, since='2019-06-01', until='2020-06-01')),
+    ('get_options_trades',
+     lambda fx: fx.warm_broker(),
+     lambda fx, broker: broker.get_options_trades()),
+    ('ledger',
+     lambda fx: fx.options_trades,
+     lambda fx, trades: list(iter_symbol_ledgers(trades))),
+    ('month_totals',
+     lambda fx: fx.options_trades,
+     lambda fx, trades: profit_totals(trades, 'month')),
+    ('trade_grid_tables',
+     lambda fx: fx.ledgers,
+     lambda fx, ledgers: [_get_trade_grid(ledger) for ledger in ledgers]),
+    ('trade_sequences',
+     lambda fx: fx.ledgers,
+     lambda fx, ledgers: [_get_trade_sequence(ledger)
+                          for ledger in ledgers]),
+    ('trade_grid_render',
+     lambda fx: fx.options_trades,
+     lambda fx, trades: trade_grid(trades, out=io.StringIO())),
+)
+
+
+def run_size(size, repeat, seed, num_symbols):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'transactions.json')
+        with open(path, 'w') as f:
+            write_transactions(f, size, seed, num_symbols)
+        fixture = _Fixture(path)
+        timings = {}
+        for name, setup, fn in STAGES:
+            timings[name] = _best_time(lambda arg: fn(fixture, arg),
+                                       lambda: setup(fixture), repeat)
+            print(f"  {name:<22} {timings[name] * 1000:10.2f} ms",
+                  file=sys.stderr)
+        return {
+            'transactions': size,
+            'trades': len(fixture.td_trades),
+            'options_trades': len(fixture.options_trades),
+            'seconds': timings,
+        }
+
+
+def compare(before, after):
+    """
+    Prints the per-stage speedup of after over before, for every size
+    present in both result files.
+    """
+    print(f"Comparing {before['meta'].get('commit')} -> "
+          f"{after['meta'].get('commit')} (speedup, higher is better)")
+    for size, result in after['results'].items():
+        old = before['results'].get(size)
+        if old is None:
+            continue
+        print(f"{size} transactions:")
+        for stage, seconds in result['seconds'].items():
+            old_seconds = old['seconds'].get(stage)
+            if old_seconds is None or not seconds:
+                continue
+            print(f"  {stage:<22} {old_seconds * 1000:10.2f} ms -> "
+                  f"{seconds * 1000:10.2f} ms  {old_seconds / seconds:6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated transaction counts")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs per stage, the best one is kept")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--symbols', type=int, default=50,
+                        help="Number of distinct underlying symbols")
+    parser.add_argument('--output', help="Write results to this JSON file")
+    parser.add_argument('--compare',
+                        help="Results JSON file of an earlier run to "
+                        "compare against")
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'symbols': args.symbols,
+        },
+        'results': {},
+    }
+    for size in (int(s) for s in args.sizes.split(',')):
+        print(f"{size} transactions:", file=sys.stderr)
+        results['results'][str(size)] = run_size(size, args.repeat,
+                                                 args.seed, args.symbols)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
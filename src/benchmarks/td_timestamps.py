@@ -0,0 +1,65 @@
+"""
+Compares per-transaction timestamp parsing cost of dateutil against the
+TD fast path used by TdTrade.
+
+Run from the src directory:
+
+    python -m benchmarks.td_timestamps
+"""
+import timeit
+
+import dateutil.parser
+
+from thetalib.brokers.providers.td import parse_td_datetime, parse_td_date
+
+
+TRANSACTION = {
+    'transactionDate': '2021-04-16T19:53:31+0000',
+    'orderDate': '2021-04-16T19:53:30+0000',
+    'settlementDate': '2021-04-19',
+    'transactionItem': {
+        'instrument': {
+            'optionExpirationDate': '2021-04-16T05:00:00+0000',
+        },
+    },
+}
+
+
+def parse_dateutil(txn):
+    instrument = txn['transactionItem']['instrument']
+    return (
+        dateutil.parser.parse(txn['transactionDate']),
+        dateutil.parser.parse(txn['orderDate']),
+        dateutil.parser.parse(txn['settlementDate']).date(),
+        dateutil.parser.parse(instrument['optionExpirationDate']),
+    )
+
+
+def parse_fast(txn):
+    instrument = txn['transactionItem']['instrument']
+    return (
+        parse_td_datetime(txn['transactionDate']),
+        parse_td_datetime(txn['orderDate']),
+        parse_td_date(txn['settlementDate']),
+        parse_td_datetime(instrument['optionExpirationDate']),
+    )
+
+
+def _time_per_call(fn, number):
+    best = min(timeit.repeat(lambda: fn(TRANSACTION), number=number,
+                             repeat=5))
+    return best / number
+
+
+def main(number=10000):
+    assert parse_dateutil(TRANSACTION) == parse_fast(TRANSACTION)
+    before = _time_per_call(parse_dateutil, number)
+    after = _time_per_call(parse_fast, number)
+    print("Timestamp parsing cost per transaction (4 fields):")
+    print(f"  dateutil:  {before * 1e6:8.2f} us")
+    print(f"  fast path: {after * 1e6:8.2f} us")
+    print(f"  speedup:   {before / after:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,11 @@
+import os
 import sys
 import argparse
 
 from colorama import init as colorama_init
 
 import thetalib.config
-from thetalib.brokers import get_broker_providers
-from thetalib.ui.components import trade_grid
+from thetalib import profiling
 
 
 colorama_init()
@@ -16,7 +16,8 @@ subparsers = cli.add_subparsers(dest="subcommand")
 # some helpers for subcommands
 # https://mike.depalatis.net/blog/simplifying-argparse.html
 def fn_name_to_cmd_name(fn_name):
-    return fn_name.lstrip('cmd_').replace('_', '-')
+    # Not lstrip, which would also eat the leading "d" of "daemon"
+    return fn_name[len('cmd_'):].replace('_', '-')
 
 
 def subcommand(args=[], parent=subparsers, help=None):
@@ -26,6 +27,7 @@ def subcommand(args=[], parent=subparsers, help=None):
         for arg in args:
             parser.add_argument(*arg[0], **arg[1])
         parser.set_defaults(func=func)
+        return func
     return decorator
 
 
@@ -33,15 +35,31 @@ def argument(*name_or_flags, **kwargs):
     return ([*name_or_flags], kwargs)
 
 
+def positive_float(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a number: {value}")
+    # Also rules out nan and inf, which time.sleep doesn't take
+    if not 0 < number < float('inf'):
+        raise argparse.ArgumentTypeError(
+            f"must be positive and finite: {value}")
+    return number
+
+
 @subcommand(help="List brokers")
 def cmd_list_brokers(config, args):
     print("Brokers")
-    for broker in config.brokers:
-        print(f"  - {broker}")
+    # Read straight from the config data so we don't have to import and
+    # initialize every broker provider just to list them.
+    for broker_cfg in config.data['brokers']:
+        print(f"  - {broker_cfg['name']} ({broker_cfg['provider']})")
 
 
 @subcommand(help="Add broker")
 def cmd_add_broker(config, args):
+    from thetalib.brokers import get_broker_providers
+
     print("Add broker")
     providers = get_broker_providers()
     provider_names = list(providers.keys())
@@ -85,42 +103,188 @@ def cmd_remove_broker(config, args):
              argument("--since",
                       help="Only include trades since this date"),
              argument("--until",
-                      help="Only include trades until this date")],
+                      help="Only include trades until this date"),
+             argument("--all-accounts", action="store_true",
+                      help=("Analyze all configured broker accounts "
+                            "together")),
+             argument("--format", default="grid",
+                      choices=("grid", "ndjson", "csv", "json"),
+                      help=("Output format. Everything but grid is "
+                            "uncolored and machine-readable")),
+             argument("--watch", type=positive_float, metavar="SECONDS",
+                      help=("Keep running, checking for new trades every "
+                            "SECONDS and showing the symbols they changed "
+                            "(grid format only)")),
+             argument("--by-month", action="store_true",
+                      help=("Also total profits by calendar month (UTC). "
+                            "Not available with --watch"))],
             help="Analyze options profitability")
 def cmd_analyze_options(config, args):
-    print("Options profitability tracking")
+    with profiling.span('import'):
+        from thetalib.brokers import TradeTable, get_all_options_trades
+
+    if args.format == "grid":
+        print("Options profitability tracking")
     symbols = set([s.upper() for s in args.symbols])
-    broker = None
 
-    if args.account:
+    if args.all_accounts:
+        brokers = config.brokers
+    elif args.account:
         broker = config.get_broker_by_name(args.account)
         if broker is None:
             print(f"Couldn't find broker with name {args.account}")
             print("Available broker accounts:")
-            cmd_list_brokers(config)
+            cmd_list_brokers(config, args)
             sys.exit(1)
+        brokers = [broker]
     else:
-        if len(config.brokers):
-            broker = config.brokers[0]
-        else:
-            print("No brokers configured. Please use the add-broker command.")
-            sys.exit(1)
+        brokers = config.brokers[:1]
+
+    if not brokers:
+        print("No brokers configured. Please use the add-broker command.")
+        sys.exit(1)
+
+    if args.watch is not None and args.format != "grid":
+        print("--watch only works with the grid format")
+        sys.exit(1)
+    if args.watch is not None and args.by_month:
+        print("--by-month doesn't work with --watch")
+        sys.exit(1)
+
+    if len(brokers) == 1:
+        trades = brokers[0].get_options_trades(symbols, since=args.since,
+                                               until=args.until)
+    else:
+        trades = get_all_options_trades(brokers, symbols, since=args.since,
+                                        until=args.until)
+    try:
+        with profiling.span('render'):
+            if args.watch is not None:
+                from thetalib.ui.components import watch_trade_grid
+
+                def poll():
+                    return TradeTable.concat(
+                        broker.poll_options_trades(symbols,
+                                                   since=args.since,
+                                                   until=args.until)
+                        for broker in brokers)
+
+                watch_trade_grid(trades, poll, args.watch)
+            elif args.format == "grid":
+                from thetalib.ui.components import trade_grid
+                trade_grid(trades, by_month=args.by_month)
+            else:
+                from thetalib.ui.formats import write_report
+                write_report(trades, args.format, sys.stdout,
+                             by_month=args.by_month)
+    except KeyboardInterrupt:
+        # The way out of --watch
+        pass
+    except BrokenPipeError:
+        # The reader (e.g. head) went away. Point stdout at devnull so the
+        # interpreter doesn't complain again while flushing on exit (unless
+        # we're running in the daemon, which handles that itself).
+        if sys.stdout is sys.__stdout__:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
 
-    trades = broker.get_options_trades(symbols, since=args.since,
-                                       until=args.until)
-    print(trade_grid(trades))
+
+@subcommand(help=("Run in the background, keeping brokers, API sessions "
+                  "and parsed trades warm for other thetactl commands"))
+def cmd_daemon(config, args):
+    from thetalib.daemon import serve
+
+    serve(run_argv)
+
+
+def run_argv(config, argv):
+    args = cli.parse_args(argv)
+    if args.subcommand is None or args.subcommand in LOCAL_COMMANDS:
+        print(f"{args.subcommand} can't run in the daemon")
+        sys.exit(1)
+    if getattr(args, 'watch', None) is not None:
+        # It would never return, and the daemon serves one command at a
+        # time
+        print("--watch can't run in the daemon")
+        sys.exit(1)
+    args.func(config, args)
+
+
+# Commands that always run in the calling process: interactive ones, the
+# ones that change the config, and the daemon itself.
+LOCAL_COMMANDS = ('add-broker', 'remove-broker', 'daemon')
 
 
 def main():
     cli.add_argument("--account")
+    cli.add_argument("--profile", action="store_true",
+                     help=("Print a per-stage timing breakdown (to stderr) "
+                           "at exit"))
+    cli.add_argument("--profile-output", metavar="FILE",
+                     help=("Also run under cProfile and dump its stats to "
+                           "FILE (implies --profile)"))
+    cli.add_argument("--metrics-file", metavar="FILE",
+                     help=("Append this run's broker API request metrics "
+                           "to FILE, as a JSON line"))
+    cli.add_argument("--no-daemon", action="store_true",
+                     help=("Don't hand the command to a running thetactl "
+                           "daemon"))
+    cli.add_argument("--parse-workers", type=int, metavar="N",
+                     help=("Parse broker transactions in N processes (0 "
+                           "for one per CPU). Only pays off for large "
+                           "histories."))
     args = cli.parse_args()
     cmd = args.subcommand
-    config = thetalib.config.get_user_config()
+    # Profiling and metrics are about this process, so those runs always
+    # stay local. So does --watch, which would keep the daemon busy, and
+    # --parse-workers, since the daemon's trades are already parsed (start
+    # the daemon itself with it instead).
+    if (cmd is not None and cmd not in LOCAL_COMMANDS and not args.no_daemon
+            and not (args.profile or args.profile_output
+                     or args.metrics_file
+                     or getattr(args, 'watch', None) is not None
+                     or args.parse_workers is not None)):
+        from thetalib.daemon import run_client
 
-    if cmd is None:
-        cli.print_help()
-    else:
-        args.func(config, args)
+        code = run_client(sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+    if args.profile or args.profile_output:
+        profiling.enable(cprofile=bool(args.profile_output))
+    if args.parse_workers is not None:
+        from thetalib.brokers import Broker
+
+        Broker.parse_workers = args.parse_workers
+
+    try:
+        with profiling.span('config'):
+            config = thetalib.config.get_user_config()
+
+        if cmd is None:
+            cli.print_help()
+        else:
+            args.func(config, args)
+    finally:
+        profiling.report(cprofile_path=args.profile_output)
+        report_metrics(args)
+
+
+def report_metrics(args):
+    # Only brokers that made API requests will have imported the metrics
+    # module, so don't pay for importing it otherwise.
+    metrics = sys.modules.get('thetalib.metrics')
+    if metrics is None or not metrics.request_metrics.endpoints:
+        return
+    import logging
+
+    request_metrics = metrics.request_metrics
+    request_metrics.log_summary(logging.getLogger('thetalib.metrics'))
+    if profiling.is_enabled():
+        print("API requests:", file=sys.stderr)
+        for line in request_metrics.summary_lines():
+            print(f"  {line}", file=sys.stderr)
+    if args.metrics_file:
+        request_metrics.append_to_file(args.metrics_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+from thetalib.brokers.base import (
+    AssetType,
+    Instruction,
+    TradeTable,
+    ts_to_datetime,
+)
+
+
+"""
+Grouped P&L reductions over TradeTable columns.
+
+Totals are sums of Trade.cost in PRICE_SCALE fixed-point, so both code
+paths are exact. NumPy is optional: when it's installed and a table has
+at least NUMPY_MIN_TRADES rows the reductions run as array operations,
+otherwise as plain Python loops over the columns.
+"""
+
+
+# Tables smaller than this aren't worth the NumPy conversion overhead
+NUMPY_MIN_TRADES = 10000
+
+GROUP_BY = ('symbol', 'option_symbol', 'month')
+
+_DAY_US = 24 * 60 * 60 * 1000000
+
+_numpy = None
+
+
+def _get_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def should_use_numpy(trades: TradeTable):
+    return len(trades) >= NUMPY_MIN_TRADES and _get_numpy() is not None
+
+
+def _profit_totals_python(trades, by):
+    costs = trades.costs_fixed()
+    if by == 'month':
+        keys = []
+        month_by_day = {}
+        for ts in trades.transaction_ts:
+            day = ts // _DAY_US
+            month = month_by_day.get(day)
+            if month is None:
+                month = month_by_day[day] = f"{ts_to_datetime(ts):%Y-%m}"
+            keys.append(month)
+        pool = None
+    elif by == 'symbol':
+        keys, pool = trades.symbol_id, trades.symbols
+    else:
+        keys, pool = trades.option_symbol_id, trades.option_symbols
+
+    totals = {}
+    for key, cost in zip(keys, costs):
+        totals[key] = totals.get(key, 0) + cost
+    if pool is None:
+        return {key: totals[key] for key in sorted(totals)}
+    return {
+        pool[key] if key >= 0 else None: totals[key]
+        for key in sorted(totals)
+    }
+
+
+def _profit_totals_numpy(trades, by):
+    np = _get_numpy()
+    price = np.frombuffer(trades.price_fixed, dtype=np.int64)
+    quantity = np.frombuffer(trades.quantity, dtype=np.int64)
+    instruction = np.frombuffer(trades.instruction_code, dtype=np.int8)
+    asset_type = np.frombuffer(trades.asset_type_code, dtype=np.int8)
+    costs = (price * quantity
+             * np.where(instruction == Instruction.BUY.value, -1, 1)
+             * np.where(asset_type == AssetType.OPTION.value, 100, 1))
+
+    if by == 'month':
+        ts = np.frombuffer(trades.transaction_ts, dtype=np.int64)
+        months = ts.astype('datetime64[us]').astype('datetime64[M]')
+        uniques, ids = np.unique(months, return_inverse=True)
+        names = [str(month) for month in uniques]
+    else:
+        if by == 'symbol':
+            column, pool = trades.symbol_id, trades.symbols
+        else:
+            column, pool = trades.option_symbol_id, trades.option_symbols
+        # Shift by one so that -1 (None) gets a group of its own
+        ids = np.frombuffer(column, dtype=np.int32).astype(np.intp) + 1
+        names = [None] + list(pool.strings)
+
+    if not len(ids):
+        return {}
+    # Sort by group and reduce each run. Unlike bincount (which goes
+    # through float64) this keeps exact int64 sums.
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(
+        np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))
+    totals = np.add.reduceat(costs[order], starts)
+    return {
+        names[i]: int(total)
+        for i, total in zip(sorted_ids[starts], totals)
+    }
+
+
+def profit_totals(trades: TradeTable, by='symbol', use_numpy=None):
+    """
+    Returns a dict mapping each group to the sum of Trade.cost (in
+    PRICE_SCALE fixed-point) of its trades.
+
+    - by :: 'symbol', 'option_symbol' (None for equity trades) or 'month'
+    ("YYYY-MM", UTC)
+    - use_numpy :: Force the NumPy (True) or pure Python (False) path. By
+    default NumPy is used if available and trades is large enough.
+
+    Symbol groups come out in interning order and months in calendar
+    order, whichever path is used.
+    """
+    if by not in GROUP_BY:
+        raise ValueError(f"Can't group by {by}")
+    if use_numpy is None:
+        use_numpy = should_use_numpy(trades)
+    if use_numpy:
+        return _profit_totals_numpy(trades, by)
+    return _profit_totals_python(trades, by)
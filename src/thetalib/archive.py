@@ -0,0 +1,404 @@
+import os
+import json
+import mmap
+import hashlib
+import logging
+import threading
+from array import array
+
+from thetalib.config import get_user_data_dir
+
+
+"""
+Raw broker transactions on disk, read through mmap.
+
+Every archive is a data file plus an offset index: a flat array of int64
+(transaction id, offset, length) triples locating each transaction's JSON
+in the data file. Looking a transaction up is a dict lookup plus a slice
+of the mapping, so trades can point into the archive by transaction id
+without keeping (or copying) the raw objects, and every process reading
+the same archive shares the OS page cache.
+
+- TransactionArchive :: Owns its data file, <name>.ndjson, and appends
+  to it. This is where transactions synced from an API are kept.
+- SourceFileArchive :: Indexes a JSON array file that's already on disk
+  (e.g. a TD export) in place, without copying it.
+
+Next to its index, an archive can keep the trades parsed from it (see
+load_trade_cache), so that the next run only has to parse the entries
+added since.
+"""
+
+
+# Fields per index entry: transaction id, offset, length
+_INDEX_FIELDS = 3
+_INDEX_ENTRY_BYTES = _INDEX_FIELDS * array('q').itemsize
+
+logger = logging.getLogger(__name__)
+
+
+def get_archive_dir():
+    path = os.path.join(get_user_data_dir(), 'archive')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _write_atomic(path, write):
+    # Readers see either the old file or the complete new one. The temp
+    # file has to be unique per writer, not just per process: brokers are
+    # loaded in threads, and two of them can share an archive.
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f'{os.path.basename(path)}.', suffix='.tmp',
+        dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _encode(transaction):
+    return json.dumps(transaction, separators=(',', ':')).encode() + b'\n'
+
+
+class _MappedArchive:
+    """
+    Lookups of transactions in data_path through the index in index_path.
+    Safe to share between threads.
+    """
+
+    def __init__(self, data_path, index_path, cache_path):
+        self.data_path = data_path
+        self.index_path = index_path
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        # transaction id -> (offset, length)
+        self._offsets = {}
+        self._index_read = 0
+        self._mm = None
+        with self._lock:
+            self._read_index()
+
+    def _read_index(self):
+        """
+        Loads index entries appended (by us or other processes) since we
+        last looked.
+        """
+        try:
+            with open(self.index_path, 'rb') as f:
+                f.seek(self._index_read)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # Ignore a partially written trailing entry
+        data = data[:len(data) - len(data) % _INDEX_ENTRY_BYTES]
+        entries = array('q')
+        entries.frombytes(data)
+        offsets = self._offsets
+        for i in range(0, len(entries), _INDEX_FIELDS):
+            offsets[entries[i]] = (entries[i + 1], entries[i + 2])
+        self._index_read += len(data)
+
+    def _map(self, end):
+        """
+        Returns a mapping of the data file covering at least end bytes.
+        """
+        if self._mm is None or len(self._mm) < end:
+            with open(self.data_path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._mm is not None:
+                try:
+                    self._mm.close()
+                except BufferError:
+                    # get_raw views still point into it; let those keep
+                    # the old mapping alive
+                    pass
+            self._mm = mm
+        return self._mm
+
+    def _locate(self, transaction_id):
+        location = self._offsets.get(transaction_id)
+        if location is None:
+            # Maybe another process appended it since
+            self._read_index()
+            location = self._offsets.get(transaction_id)
+        return location
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, transaction_id):
+        with self._lock:
+            return self._locate(transaction_id) is not None
+
+    def get_raw(self, transaction_id):
+        """
+        Returns the archived JSON of a transaction as a memoryview into
+        the mapping (no copy), or None.
+        """
+        with self._lock:
+            location = self._locate(transaction_id)
+            if location is None:
+                return None
+            offset, length = location
+            return memoryview(self._map(offset + length))[
+                offset:offset + length]
+
+    def get(self, transaction_id):
+        """
+        Returns a transaction decoded from the archive, or None.
+        """
+        raw = self.get_raw(transaction_id)
+        if raw is None:
+            return None
+        with raw:
+            return json.loads(bytes(raw))
+
+    def iter_transactions(self, transaction_ids=None):
+        """
+        Yields archived transactions: those with the given ids, in that
+        order (skipping ids that aren't archived), or by default all of
+        them in data file order. Useful for re-parsing trades without
+        going back to the broker.
+        """
+        with self._lock:
+            self._read_index()
+            if transaction_ids is None:
+                locations = sorted(self._offsets.values())
+            else:
+                offsets = self._offsets
+                locations = [offsets[tid] for tid in transaction_ids
+                             if tid in offsets]
+            if not locations:
+                return
+            mm = self._map(max(offset + length
+                               for offset, length in locations))
+        for offset, length in locations:
+            yield json.loads(mm[offset:offset + length])
+
+    def entry_count(self):
+        """
+        Returns the number of entries in the index, counting transactions
+        archived more than once every time.
+        """
+        with self._lock:
+            self._read_index()
+            return self._index_read // _INDEX_ENTRY_BYTES
+
+    def iter_entries(self, start=0):
+        """
+        Yields (transaction id, transaction) for the index entries from
+        position start on, in index order: the order transactions were
+        archived in, or their order in the file for a SourceFileArchive.
+        """
+        with self._lock:
+            self._read_index()
+            end = self._index_read
+        begin = start * _INDEX_ENTRY_BYTES
+        if begin >= end:
+            return
+        with open(self.index_path, 'rb') as f:
+            f.seek(begin)
+            entries = array('q')
+            entries.frombytes(f.read(end - begin))
+        with self._lock:
+            mm = self._map(max(entries[i + 1] + entries[i + 2] for i in
+                               range(0, len(entries), _INDEX_FIELDS)))
+        for i in range(0, len(entries), _INDEX_FIELDS):
+            offset, length = entries[i + 1], entries[i + 2]
+            yield entries[i], json.loads(mm[offset:offset + length])
+
+    def load_trade_cache(self):
+        """
+        Returns what was last saved with save_trade_cache, or None if
+        there's nothing (usable) saved.
+        """
+        import pickle
+
+        try:
+            with open(self.cache_path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Truncated, or written by an incompatible version
+            logger.info(f"Ignoring unreadable trade cache {self.cache_path}")
+            return None
+
+    def save_trade_cache(self, cache):
+        """
+        Saves cache (anything picklable, typically trades parsed from the
+        first entry_count() entries) with the archive.
+        """
+        import pickle
+
+        _write_atomic(self.cache_path, lambda f: pickle.dump(
+            cache, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def close(self):
+        with self._lock:
+            if self._mm is not None:
+                try:
+                    self._mm.close()
+                except BufferError:
+                    pass
+                self._mm = None
+
+
+class TransactionArchive(_MappedArchive):
+    """
+    Append-only NDJSON archive of raw transactions, in <name>.ndjson with
+    its index in <name>.idx (and its trade cache in <name>.trades). Can be
+    used as a TradeTable.raw_archive.
+
+    A transaction appended again with different content gets a new line,
+    and the index entry appended last wins. Writers take an exclusive
+    flock on the data file, so several processes can append to the same
+    archive.
+
+    - name :: Archive file name (without extension), in the archive dir
+    - id_field :: Key holding the transaction id in the raw objects
+    - directory :: Where to keep the archive. Defaults to the archive dir
+    in the user data dir.
+    """
+
+    def __init__(self, name, id_field='transactionId', directory=None):
+        directory = directory or get_archive_dir()
+        self.id_field = id_field
+        path = os.path.join(directory, name)
+        super().__init__(f'{path}.ndjson', f'{path}.idx', f'{path}.trades')
+
+    def append(self, transactions, replace=True):
+        """
+        Archives transactions. Transactions that are already archived are
+        skipped if their content is unchanged, or without even looking at
+        the content if replace is False.
+
+        Returns the number of transactions written.
+        """
+        import fcntl
+
+        transactions = list(transactions)
+        if not transactions:
+            return 0
+        id_field = self.id_field
+        with self._lock, open(self.data_path, 'ab') as data, \
+                open(self.index_path, 'ab') as index:
+            fcntl.flock(data, fcntl.LOCK_EX)
+            try:
+                # Other processes may have appended while we waited
+                self._read_index()
+                start = data.seek(0, os.SEEK_END)
+                batch = bytearray()
+                entries = array('q')
+                for t in transactions:
+                    tid = t[id_field]
+                    location = self._offsets.get(tid)
+                    if location is not None and not replace:
+                        continue
+                    line = _encode(t)
+                    if location is not None and location[1] == len(line) \
+                            and self._stored(location, start, batch) == line:
+                        continue
+                    offset = start + len(batch)
+                    entries.extend((tid, offset, len(line)))
+                    self._offsets[tid] = (offset, len(line))
+                    batch += line
+                if not entries:
+                    return 0
+                # Data first, so the index never points past the data
+                data.write(batch)
+                data.flush()
+                # Drop whatever a writer that crashed mid-entry left behind
+                index.truncate(self._index_read)
+                index.write(entries.tobytes())
+                index.flush()
+                self._index_read += len(entries) * entries.itemsize
+            finally:
+                fcntl.flock(data, fcntl.LOCK_UN)
+        return len(entries) // _INDEX_FIELDS
+
+    def _stored(self, location, start, batch):
+        # Archived bytes at location, which may still be in the batch
+        # being appended (from start)
+        offset, length = location
+        if offset >= start:
+            return bytes(batch[offset - start:offset - start + length])
+        return self._map(offset + length)[offset:offset + length]
+
+
+class SourceFileArchive(_MappedArchive):
+    """
+    Archive over a JSON array file of raw transactions, read in place.
+
+    The index is built by whoever reads the whole file first (see
+    write_index) and is tied to the file's size and modification time,
+    so an edited file is indexed again instead of being read at stale
+    offsets.
+
+    - path :: The JSON array file
+    - directory :: Where to keep the index. Defaults to the archive dir in
+    the user data dir.
+    """
+
+    def __init__(self, path, directory=None):
+        path = os.path.abspath(os.path.expanduser(path))
+        directory = directory or get_archive_dir()
+        st = os.stat(path)
+        self.identity = (st.st_size, st.st_mtime_ns)
+        key = hashlib.sha1(path.encode()).hexdigest()[:16]
+        self._index_prefix = os.path.join(directory, f'file-{key}-')
+        version = f'{self._index_prefix}{st.st_size}-{st.st_mtime_ns}'
+        super().__init__(path, f'{version}.idx', f'{version}.trades')
+
+    def is_current(self):
+        """
+        True if the file hasn't changed since this archive was opened.
+        """
+        try:
+            st = os.stat(self.data_path)
+        except FileNotFoundError:
+            return False
+        return (st.st_size, st.st_mtime_ns) == self.identity
+
+    def is_indexed(self):
+        return os.path.exists(self.index_path)
+
+    def _locate(self, transaction_id):
+        # Offsets into an older version of the file would point at the
+        # wrong bytes
+        if not self.is_current():
+            return None
+        return super()._locate(transaction_id)
+
+    def write_index(self, entries):
+        """
+        Saves the index of the file. entries is an iterable of
+        (transaction id, offset, length) tuples, with offsets and lengths
+        in bytes (see iter_json_array's offsets option).
+        """
+        index = array('q')
+        for entry in entries:
+            index.extend(entry)
+        _write_atomic(self.index_path, index.tofile)
+        # Indexes (and trade caches) of earlier versions of the file are of
+        # no use anymore
+        directory = os.path.dirname(self.index_path)
+        prefix = os.path.basename(self._index_prefix)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith(prefix) and name.endswith(('.idx', '.trades')) \
+                    and path not in (self.index_path, self.cache_path):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    # Another writer cleaned it up first
+                    pass
+        with self._lock:
+            self._offsets = {}
+            self._index_read = 0
+            self._read_index()
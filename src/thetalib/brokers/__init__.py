@@ -1,9 +1,14 @@
 from thetalib.brokers.base import (
     Broker,
     Trade,
+    TradeIndex,
+    TradeRecord,
+    TradeTable,
+    TradeView,
     Instruction,
     OptionType,
     PositionEffect,
+    get_all_options_trades,
 )
 from thetalib.brokers.providers import *
 
@@ -1,15 +1,18 @@
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from enum import Enum
 import datetime
 from decimal import Decimal
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import chain, islice
 import logging
 
-import pytz
-import dateparser
-import tzlocal
-
 from thetalib import config
+from thetalib.dates import resolve_date_expression
+from thetalib.profiling import span
 
 
 logging.basicConfig(
@@ -53,31 +56,16 @@ class OptionType(Enum):
         return "PUT" if self == OptionType.PUT else "CALL"
 
 
-@dataclass
-class Trade:
+class _TradeMixin:
     """
-    Represents a single trade.
+    Derived trade properties shared by Trade, TradeRecord and TradeView.
     """
 
-    api_object: str
-    transaction_datetime: datetime.datetime
-    order_datetime: datetime.datetime
-    settlement_date: datetime.date
-    instruction: Instruction
-    asset_type: AssetType
-    option_type: OptionType
-    position_effect: PositionEffect
-    fees_and_commissions: Decimal
-    quantity: int
-    price: Decimal
-    symbol: str
-    option_expiration: datetime.datetime
-    strike: Decimal
-    option_symbol: str
+    __slots__ = ()
 
     @property
     def dte(self):
-        now = datetime.datetime.now(pytz.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
         if self.option_expiration > now:
             return (self.option_expiration - now).days
 
@@ -107,6 +95,675 @@ class Trade:
                 f"{self.ieffect} {self.quantity}@{self.price:<6}")
 
 
+@dataclass
+class Trade(_TradeMixin):
+    """
+    Represents a single trade.
+    """
+
+    api_object: str
+    transaction_datetime: datetime.datetime
+    order_datetime: datetime.datetime
+    settlement_date: datetime.date
+    instruction: Instruction
+    asset_type: AssetType
+    option_type: OptionType
+    position_effect: PositionEffect
+    fees_and_commissions: Decimal
+    quantity: int
+    price: Decimal
+    symbol: str
+    option_expiration: datetime.datetime
+    strike: Decimal
+    option_symbol: str
+
+    @property
+    def transaction_id(self):
+        """
+        The broker's id for the transaction, if known.
+        """
+        return None
+
+
+@dataclass(frozen=True, repr=False)
+class TradeRecord(_TradeMixin):
+    """
+    Compact, immutable trade. Unlike Trade it doesn't hold on to the raw
+    API object: that's loaded on demand, by transaction_id, from archive
+    (any object with a get(transaction_id) method returning the raw object
+    or None, e.g. thetalib.archive.TransactionArchive).
+
+    archive isn't part of the record's value: it's not a dataclass field,
+    so it's left out of comparisons and hashing, and records are pickled
+    without it. Use from_trade to create records with one.
+    """
+
+    # Spelled out since dataclass(slots=True) needs Python 3.10
+    __slots__ = (
+        'transaction_id', 'transaction_datetime', 'order_datetime',
+        'settlement_date', 'instruction', 'asset_type', 'option_type',
+        'position_effect', 'fees_and_commissions', 'quantity', 'price',
+        'symbol', 'option_expiration', 'strike', 'option_symbol', 'archive',
+    )
+
+    transaction_id: int
+    transaction_datetime: datetime.datetime
+    order_datetime: datetime.datetime
+    settlement_date: datetime.date
+    instruction: Instruction
+    asset_type: AssetType
+    option_type: OptionType
+    position_effect: PositionEffect
+    fees_and_commissions: Decimal
+    quantity: int
+    price: Decimal
+    symbol: str
+    option_expiration: datetime.datetime
+    strike: Decimal
+    option_symbol: str
+
+    def __post_init__(self):
+        object.__setattr__(self, 'archive', None)
+
+    def __repr__(self):
+        return f"TradeRecord({self})"
+
+    def __reduce__(self):
+        return (type(self),
+                tuple(getattr(self, f.name) for f in fields(self)))
+
+    @classmethod
+    def from_trade(cls, trade, archive=None):
+        """
+        Returns a TradeRecord for a Trade (or anything with the same
+        attributes).
+        """
+        record = cls(
+            trade.transaction_id,
+            trade.transaction_datetime,
+            trade.order_datetime,
+            trade.settlement_date,
+            trade.instruction,
+            trade.asset_type,
+            trade.option_type,
+            trade.position_effect,
+            trade.fees_and_commissions,
+            trade.quantity,
+            trade.price,
+            trade.symbol,
+            trade.option_expiration,
+            trade.strike,
+            trade.option_symbol,
+        )
+        object.__setattr__(record, 'archive', archive)
+        return record
+
+    @property
+    def api_object(self):
+        if self.archive is None or self.transaction_id is None:
+            return None
+        return self.archive.get(self.transaction_id)
+
+
+class ArchiveChain:
+    """
+    Looks raw API objects up in several archives, in order. Used for
+    tables merged from brokers with different archives.
+    """
+
+    def __init__(self, archives):
+        self.archives = []
+        for archive in archives:
+            self.add(archive)
+
+    def add(self, archive):
+        if isinstance(archive, ArchiveChain):
+            for a in archive.archives:
+                self.add(a)
+        elif archive is not None and archive not in self.archives:
+            self.archives.append(archive)
+
+    def get(self, transaction_id):
+        for archive in self.archives:
+            raw = archive.get(transaction_id)
+            if raw is not None:
+                return raw
+        return None
+
+
+def _merge_archives(a, b):
+    if a is None or a is b:
+        return b
+    if b is None:
+        return a
+    return ArchiveChain([a, b])
+
+
+# Fixed-point scale for money columns in TradeTable (prices, strikes, fees,
+# costs). Six decimal places is more precision than any broker reports.
+PRICE_SCALE = 1000000
+
+# Sentinel for missing values in integer columns (e.g. the expiration of an
+# equity trade).
+MISSING = -(2 ** 63)
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def datetime_to_ts(dt):
+    """
+    Converts a tz-aware datetime to integer microseconds since the epoch.
+    """
+    if dt is None:
+        return MISSING
+    return (dt - _EPOCH) // _MICROSECOND
+
+
+def ts_to_datetime(ts):
+    """
+    Inverse of datetime_to_ts. Returns a UTC datetime.
+    """
+    if ts == MISSING:
+        return None
+    return _EPOCH + datetime.timedelta(microseconds=ts)
+
+
+def to_fixed(value):
+    """
+    Converts a Decimal (or anything Decimal accepts) to a PRICE_SCALE
+    fixed-point integer.
+    """
+    if value is None:
+        return MISSING
+    return int((Decimal(value) * PRICE_SCALE).to_integral_value())
+
+
+def from_fixed(value):
+    """
+    Converts a PRICE_SCALE fixed-point integer back to a Decimal.
+    """
+    if value == MISSING:
+        return None
+    return Decimal(value) / PRICE_SCALE
+
+
+def _enum_code(value):
+    return 0 if value is None else value.value
+
+
+class StringPool:
+    """
+    Interns strings to small integer ids.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._ids = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, sid):
+        return self.strings[sid]
+
+    def intern(self, string):
+        """
+        Returns the id for string, allocating one if needed. None maps to
+        -1.
+        """
+        if string is None:
+            return -1
+        sid = self._ids.get(string)
+        if sid is None:
+            sid = len(self.strings)
+            self._ids[string] = sid
+            self.strings.append(string)
+        return sid
+
+    def lookup(self, string):
+        """
+        Returns the id for string, or None if it was never interned.
+        """
+        return self._ids.get(string)
+
+
+class TradeTable:
+    """
+    Column-oriented collection of trades.
+
+    Every trade attribute is stored in a parallel typed array:
+
+    - datetimes :: int64 microseconds since the epoch (see datetime_to_ts)
+    - settlement dates :: proleptic Gregorian ordinals
+    - enums :: int8 codes (the enum value, 0 for None)
+    - money :: int64 fixed-point with PRICE_SCALE
+    - symbols :: int32 ids into a shared StringPool (-1 for None)
+
+    Raw API objects are kept in the api_objects list unless the table is
+    created with keep_api_objects=False, in which case api_objects is None
+    and they're looked up in raw_archive (if any) by transaction_id
+    instead.
+
+    Missing values in int64 columns are stored as MISSING. Filtering,
+    sorting and grouping work on the columns and return new tables which
+    share the string pools of their parent. Indexing or iterating yields
+    TradeView objects, which behave like Trade.
+
+    - symbol_ordered :: True if the rows are known to be sorted by (symbol,
+    transaction_ts), as returned by TradeIndex.query. Order-preserving
+    operations (where, slice) carry it over.
+    """
+
+    COLUMNS = (
+        ('transaction_ts', 'q'),
+        ('order_ts', 'q'),
+        ('settlement_ordinal', 'i'),
+        ('instruction_code', 'b'),
+        ('asset_type_code', 'b'),
+        ('option_type_code', 'b'),
+        ('position_effect_code', 'b'),
+        ('fees_fixed', 'q'),
+        ('quantity', 'q'),
+        ('price_fixed', 'q'),
+        ('symbol_id', 'i'),
+        ('expiration_ts', 'q'),
+        ('strike_fixed', 'q'),
+        ('option_symbol_id', 'i'),
+        ('transaction_id', 'q'),
+    )
+
+    def __init__(self, symbols=None, option_symbols=None,
+                 keep_api_objects=True, raw_archive=None):
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.api_objects = [] if keep_api_objects else None
+        self.raw_archive = raw_archive
+        self.symbols = symbols if symbols is not None else StringPool()
+        self.option_symbols = option_symbols if option_symbols is not None \
+            else StringPool()
+        self.symbol_ordered = False
+
+    @classmethod
+    def from_trades(cls, trades, keep_api_objects=True, raw_archive=None):
+        table = cls(keep_api_objects=keep_api_objects,
+                    raw_archive=raw_archive)
+        for trade in trades:
+            table.append(trade)
+        return table
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Returns a new table holding the rows of all tables, in order.
+        """
+        tables = list(tables)
+        table = cls(keep_api_objects=all(
+            t.api_objects is not None for t in tables))
+        for other in tables:
+            table.extend(other)
+        return table
+
+    def __getstate__(self):
+        # The archive is an open file mapping, owned by the broker
+        state = self.__dict__.copy()
+        state['raw_archive'] = None
+        return state
+
+    def _empty_like(self):
+        return type(self)(self.symbols, self.option_symbols,
+                          keep_api_objects=self.api_objects is not None,
+                          raw_archive=self.raw_archive)
+
+    def extend(self, other):
+        """
+        Appends all rows of other, re-interning its symbols into this
+        table's pools if they aren't shared.
+        """
+        for name, _ in self.COLUMNS:
+            if name not in ('symbol_id', 'option_symbol_id'):
+                getattr(self, name).extend(getattr(other, name))
+        for column, pool, other_pool in (
+                ('symbol_id', self.symbols, other.symbols),
+                ('option_symbol_id', self.option_symbols,
+                 other.option_symbols)):
+            ids = getattr(other, column)
+            if pool is not other_pool:
+                remap = [pool.intern(s) for s in other_pool.strings]
+                ids = [remap[i] if i >= 0 else -1 for i in ids]
+            getattr(self, column).extend(ids)
+        if self.api_objects is not None:
+            self.api_objects.extend(other.api_objects
+                                    if other.api_objects is not None
+                                    else [None] * len(other))
+        self.raw_archive = _merge_archives(self.raw_archive,
+                                           other.raw_archive)
+
+    def append(self, trade):
+        """
+        Appends a Trade (or anything with the same attributes).
+        """
+        if trade.quantity != int(trade.quantity):
+            raise ValueError(f"Fractional quantity not supported: {trade}")
+        self.transaction_ts.append(datetime_to_ts(trade.transaction_datetime))
+        self.order_ts.append(datetime_to_ts(trade.order_datetime))
+        self.settlement_ordinal.append(trade.settlement_date.toordinal())
+        self.instruction_code.append(_enum_code(trade.instruction))
+        self.asset_type_code.append(_enum_code(trade.asset_type))
+        self.option_type_code.append(_enum_code(trade.option_type))
+        self.position_effect_code.append(_enum_code(trade.position_effect))
+        self.fees_fixed.append(to_fixed(trade.fees_and_commissions))
+        self.quantity.append(int(trade.quantity))
+        self.price_fixed.append(to_fixed(trade.price))
+        self.symbol_id.append(self.symbols.intern(trade.symbol))
+        self.expiration_ts.append(datetime_to_ts(trade.option_expiration))
+        self.strike_fixed.append(to_fixed(trade.strike))
+        self.option_symbol_id.append(
+            self.option_symbols.intern(trade.option_symbol))
+        tid = trade.transaction_id
+        self.transaction_id.append(MISSING if tid is None else tid)
+        if self.api_objects is not None:
+            self.api_objects.append(trade.api_object)
+
+    def __len__(self):
+        return len(self.transaction_ts)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("TradeTable index out of range")
+        return TradeView(self, idx)
+
+    def __iter__(self):
+        return (TradeView(self, i) for i in range(len(self)))
+
+    def take(self, indices):
+        """
+        Returns a new table holding the rows at indices, in that order.
+        """
+        table = self._empty_like()
+        for name, typecode in self.COLUMNS:
+            col = getattr(self, name)
+            setattr(table, name, array(typecode, [col[i] for i in indices]))
+        api_objects = self.api_objects
+        if api_objects is not None:
+            table.api_objects = [api_objects[i] for i in indices]
+        return table
+
+    def slice(self, start, stop):
+        """
+        Returns a new table holding rows start through stop - 1.
+        """
+        table = self._empty_like()
+        for name, _ in self.COLUMNS:
+            setattr(table, name, getattr(self, name)[start:stop])
+        if self.api_objects is not None:
+            table.api_objects = self.api_objects[start:stop]
+        table.symbol_ordered = self.symbol_ordered
+        return table
+
+    def where(self, column, predicate):
+        """
+        Returns the rows whose value in column satisfies predicate.
+        """
+        col = getattr(self, column)
+        table = self.take([i for i, v in enumerate(col) if predicate(v)])
+        table.symbol_ordered = self.symbol_ordered
+        return table
+
+    def where_in(self, column, values):
+        values = frozenset(values)
+        return self.where(column, values.__contains__)
+
+    def where_symbols(self, symbols):
+        ids = [self.symbols.lookup(s) for s in symbols]
+        return self.where_in('symbol_id', [i for i in ids if i is not None])
+
+    def argsort(self, *columns):
+        """
+        Returns row indices ordered by the given columns. The sort is
+        stable.
+        """
+        cols = [getattr(self, c) for c in columns]
+        if len(cols) == 1:
+            key = cols[0].__getitem__
+        else:
+            def key(i):
+                return tuple(col[i] for col in cols)
+        return sorted(range(len(self)), key=key)
+
+    def sort_by(self, *columns):
+        return self.take(self.argsort(*columns))
+
+    def group_indices(self, column):
+        """
+        Returns a dict mapping each distinct value in column to the list of
+        row indices holding it, in row order.
+        """
+        groups = {}
+        for i, v in enumerate(getattr(self, column)):
+            group = groups.get(v)
+            if group is None:
+                groups[v] = group = []
+            group.append(i)
+        return groups
+
+    def symbol_run_bounds(self):
+        """
+        Yields (symbol, start, stop) for each run of consecutive rows with
+        the same symbol.
+        """
+        ids = self.symbol_id
+        start = 0
+        for i in range(1, len(ids) + 1):
+            if i == len(ids) or ids[i] != ids[start]:
+                yield self.symbols[ids[start]], start, i
+                start = i
+
+    def symbol_runs(self):
+        """
+        Yields (symbol, sub-table) for each run of consecutive rows with
+        the same symbol. On a symbol_ordered table this is a group-by
+        symbol that needs no sorting.
+        """
+        for symbol, start, stop in self.symbol_run_bounds():
+            yield symbol, self.slice(start, stop)
+
+    def group_by(self, column):
+        """
+        Returns a dict mapping each distinct value in column to a
+        sub-table.
+        """
+        return {
+            v: self.take(indices)
+            for v, indices in self.group_indices(column).items()
+        }
+
+    def costs_fixed(self):
+        """
+        Returns an array of Trade.cost for every row, in PRICE_SCALE
+        fixed-point.
+        """
+        buy = Instruction.BUY.value
+        option = AssetType.OPTION.value
+        return array('q', (
+            (-p if ins == buy else p) * q * (100 if at == option else 1)
+            for p, q, ins, at in zip(self.price_fixed, self.quantity,
+                                     self.instruction_code,
+                                     self.asset_type_code)
+        ))
+
+    def total_cost(self):
+        """
+        Sum of Trade.cost over all rows, as a Decimal.
+        """
+        return from_fixed(sum(self.costs_fixed()))
+
+
+class TradeView(_TradeMixin):
+    """
+    A single row of a TradeTable, exposing the same attributes as Trade.
+    """
+
+    __slots__ = ('_table', '_idx')
+
+    def __init__(self, table, idx):
+        self._table = table
+        self._idx = idx
+
+    def __repr__(self):
+        return f"TradeView({self})"
+
+    @property
+    def api_object(self):
+        table = self._table
+        if table.api_objects is not None:
+            return table.api_objects[self._idx]
+        tid = self.transaction_id
+        if table.raw_archive is None or tid is None:
+            return None
+        return table.raw_archive.get(tid)
+
+    @property
+    def transaction_id(self):
+        tid = self._table.transaction_id[self._idx]
+        return None if tid == MISSING else tid
+
+    def to_record(self):
+        return TradeRecord.from_trade(self, self._table.raw_archive)
+
+    @property
+    def transaction_datetime(self):
+        return ts_to_datetime(self._table.transaction_ts[self._idx])
+
+    @property
+    def order_datetime(self):
+        return ts_to_datetime(self._table.order_ts[self._idx])
+
+    @property
+    def settlement_date(self):
+        return datetime.date.fromordinal(
+            self._table.settlement_ordinal[self._idx])
+
+    @property
+    def instruction(self):
+        return Instruction(self._table.instruction_code[self._idx])
+
+    @property
+    def asset_type(self):
+        return AssetType(self._table.asset_type_code[self._idx])
+
+    @property
+    def option_type(self):
+        code = self._table.option_type_code[self._idx]
+        return OptionType(code) if code else None
+
+    @property
+    def position_effect(self):
+        code = self._table.position_effect_code[self._idx]
+        return PositionEffect(code) if code else None
+
+    @property
+    def fees_and_commissions(self):
+        return from_fixed(self._table.fees_fixed[self._idx])
+
+    @property
+    def quantity(self):
+        return self._table.quantity[self._idx]
+
+    @property
+    def price(self):
+        return from_fixed(self._table.price_fixed[self._idx])
+
+    @property
+    def symbol(self):
+        return self._table.symbols[self._table.symbol_id[self._idx]]
+
+    @property
+    def option_expiration(self):
+        return ts_to_datetime(self._table.expiration_ts[self._idx])
+
+    @property
+    def strike(self):
+        return from_fixed(self._table.strike_fixed[self._idx])
+
+    @property
+    def option_symbol(self):
+        sid = self._table.option_symbol_id[self._idx]
+        return self._table.option_symbols[sid] if sid >= 0 else None
+
+
+class _IndexPartition:
+    """
+    A symbol_ordered TradeTable plus the row range of every symbol in it.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.ranges = {
+            symbol: (start, stop)
+            for symbol, start, stop in table.symbol_run_bounds()
+        }
+        self.symbols = list(self.ranges)
+
+
+class TradeIndex:
+    """
+    Trades sorted by (symbol, transaction_ts), partitioned by asset type.
+
+    Symbol lookups are dict lookups and date ranges are bisects on the
+    (already sorted) timestamps within each symbol, so queries only touch
+    the rows they return.
+    """
+
+    def __init__(self, trades: TradeTable):
+        symbols = trades.symbols
+        symbol_id = trades.symbol_id
+        ts = trades.transaction_ts
+        order = sorted(range(len(trades)),
+                       key=lambda i: (symbols[symbol_id[i]], ts[i]))
+        self.trades = trades.take(order)
+        self.trades.symbol_ordered = True
+        self._partitions = {None: _IndexPartition(self.trades)}
+        for code in set(self.trades.asset_type_code):
+            self._partitions[code] = _IndexPartition(
+                self.trades.where_in('asset_type_code', [code]))
+
+    def query(self, symbols=None, since=None, until=None,
+              asset_type=None) -> TradeTable:
+        """
+        Returns the matching trades as a symbol_ordered TradeTable.
+
+        - symbols :: Only include these symbols (all if empty or None)
+        - since, until :: Inclusive bounds in epoch microseconds (see
+        datetime_to_ts)
+        - asset_type :: Only include this AssetType
+        """
+        code = asset_type.value if asset_type is not None else None
+        partition = self._partitions.get(code)
+        if partition is None:
+            return self.trades.slice(0, 0)
+        if not symbols and since is None and until is None:
+            return partition.table
+
+        if symbols:
+            names = sorted(s for s in set(symbols) if s in partition.ranges)
+        else:
+            names = partition.symbols
+        ts = partition.table.transaction_ts
+        result = partition.table.slice(0, 0)
+        for name in names:
+            start, stop = partition.ranges[name]
+            if since is not None:
+                start = bisect_left(ts, since, start, stop)
+            if until is not None:
+                stop = bisect_right(ts, until, start, stop)
+            if start < stop:
+                result.extend(partition.table.slice(start, stop))
+        return result
+
+
 class Broker:
     """
     Abstraction for interacting with broker APIs.
@@ -122,12 +779,55 @@ class Broker:
     - from_config
     - to_config_data
     - UI_add
+
+    Owners of a broker can set on_config_change to a callable, which is
+    called (with the broker) whenever the broker updates its own config,
+    e.g. after getting new API tokens, so the change can be persisted.
     """
 
     providers = []
 
+    # Processes used to parse raw transactions into trades (see
+    # parallel_parse). 1 parses in-process, 0 uses one per CPU.
+    parse_workers = 1
+
     def __init__(self):
         self._trades = None
+        self._index = None
+        self._index_source = None
+        self.on_config_change = None
+
+    def invalidate_trades(self):
+        """
+        Drops cached trades, so that the next query gets them from the
+        provider again.
+        """
+        self._trades = None
+
+    def refresh_trades(self):
+        """
+        Brings trades that are already loaded up to date, for callers that
+        keep the broker around. New trades are added to them (see
+        provider_get_new_trades) if the provider supports it, otherwise
+        they're dropped and loaded again by the next query.
+        """
+        if self._trades is None:
+            return
+        try:
+            self._get_new_trades()
+        except NotImplementedError:
+            self.invalidate_trades()
+
+    def _get_new_trades(self):
+        new_trades = self.provider_get_new_trades()
+        if len(new_trades):
+            # The cached trades grew, so the index needs rebuilding
+            self._index = None
+        return new_trades
+
+    def config_changed(self):
+        if self.on_config_change is not None:
+            self.on_config_change(self)
 
     def __str__(self):
         return f"{self.account_name} ({self.provider_name})"
@@ -136,31 +836,66 @@ class Broker:
     def __init_subclass__(cls):
         cls.providers.append(cls)
 
-    def provider_get_trades(self, symbols=None, since=None) -> list[Trade]:
+    def provider_get_trades(self, symbols=None, since=None) -> TradeTable:
+        """
+        Returns a TradeTable (or a list of Trade objects) for this
+        broker. Caching in subclasses is recommended.
+        """
+        raise NotImplementedError
+
+    def provider_get_new_trades(self) -> TradeTable:
         """
-        Returns a list of Trade objects for this broker. Caching in subclasses
-        is recommended.
+        Optional. Returns a TradeTable of the trades that showed up since
+        provider_get_trades or the previous call, after adding them to
+        the table provider_get_trades returns.
         """
         raise NotImplementedError
 
-    def get_trades(self, symbols=None, since=None, until=None) -> list[Trade]:
+    def get_trade_index(self, symbols=None, since=None) -> TradeIndex:
+        """
+        Returns a TradeIndex over provider_get_trades(), rebuilding it only
+        when the provider hands back a different collection.
+        """
         trades = self.provider_get_trades(symbols, since)
-        localtz = tzlocal.get_localzone()
-        if symbols:
-            trades = [t for t in trades if t.symbol in symbols]
-        if since:
-            since = localtz.localize(dateparser.parse(since))
-            trades = [t for t in trades if t.transaction_datetime >= since]
-        if until:
-            until = localtz.localize(dateparser.parse(until))
-            trades = [t for t in trades if t.transaction_datetime <= until]
-        return trades
-
-    def get_options_trades(self, symbols=None, since=None, until=None):
-        return [
-            t for t in self.get_trades(symbols, since=since, until=until)
-            if t.asset_type == AssetType.OPTION
-        ]
+        if self._index is None or trades is not self._index_source:
+            with span('index'):
+                table = trades if isinstance(trades, TradeTable) \
+                    else TradeTable.from_trades(trades)
+                self._index = TradeIndex(table)
+            self._index_source = trades
+        return self._index
+
+    def _query_trades(self, symbols, since, until, asset_type=None):
+        index = self.get_trade_index(symbols, since)
+        return self._query_index(index, symbols, since, until, asset_type)
+
+    @staticmethod
+    def _query_index(index, symbols, since, until, asset_type):
+        with span('date_filter'):
+            since_ts = resolve_date_expression(since) if since else None
+            until_ts = resolve_date_expression(until) if until else None
+            return index.query(symbols, since_ts, until_ts, asset_type)
+
+    def get_trades(self, symbols=None, since=None, until=None) -> TradeTable:
+        """
+        Returns trades matching the given symbols and since/until date
+        expressions, ordered by symbol and then transaction time.
+        """
+        return self._query_trades(symbols, since, until)
+
+    def get_options_trades(self, symbols=None, since=None,
+                           until=None) -> TradeTable:
+        return self._query_trades(symbols, since, until, AssetType.OPTION)
+
+    def poll_options_trades(self, symbols=None, since=None,
+                            until=None) -> TradeTable:
+        """
+        Like get_options_trades, but only returns matching trades that are
+        new since the last query or poll (see provider_get_new_trades).
+        """
+        new_trades = self._get_new_trades()
+        return self._query_index(TradeIndex(new_trades), symbols, since,
+                                 until, AssetType.OPTION)
 
     @classmethod
     def from_config(cls, config):
@@ -185,3 +920,90 @@ class Broker:
         object.
         """
         raise NotImplementedError
+
+
+# Raw objects per parallel_parse work item
+PARSE_CHUNK_SIZE = 5000
+
+
+def _iter_chunks(items, size):
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parallel_parse(parse_chunk, raw_objects, workers=0,
+                   keep_api_objects=True,
+                   chunk_size=PARSE_CHUNK_SIZE) -> TradeTable:
+    """
+    Parses raw API objects into a TradeTable across a process pool.
+
+    raw_objects are split into chunks, and parse_chunk(chunk) (a
+    module-level function, so it can be pickled) runs in the worker
+    processes. It must return a TradeTable with one row per raw object,
+    created with keep_api_objects=False: tables travel back as a handful
+    of arrays and symbol pools, which is far cheaper than pickling Trade
+    objects. The chunks' tables are merged in order, and the raw objects
+    we already have in this process become the api_objects.
+
+    - workers :: Number of processes, 0 for one per CPU
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = _iter_chunks(raw_objects, chunk_size)
+    head = list(islice(chunks, 2))
+    if len(head) < 2 or workers == 1:
+        # Not worth starting processes for
+        results = ((chunk, parse_chunk(chunk))
+                   for chunk in chain(head, chunks))
+    else:
+        results = _parse_in_processes(parse_chunk, chain(head, chunks),
+                                      workers)
+
+    table = TradeTable(keep_api_objects=keep_api_objects)
+    for chunk, chunk_table in results:
+        if keep_api_objects:
+            chunk_table.api_objects = chunk
+        table.extend(chunk_table)
+    return table
+
+
+def _parse_in_processes(parse_chunk, chunks, workers):
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Keep a bounded number of chunks in flight, so that a streamed
+        # input isn't read (and pickled) all at once.
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.submit(parse_chunk, chunk)))
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        for chunk, future in pending:
+            yield chunk, future.result()
+
+
+# Max number of brokers fetched at the same time by get_all_options_trades
+MAX_BROKER_WORKERS = 8
+
+
+def get_all_options_trades(brokers, symbols=None, since=None, until=None,
+                           max_workers=MAX_BROKER_WORKERS) -> TradeTable:
+    """
+    Fetches options trades from all brokers concurrently and merges them
+    into a single TradeTable (in broker order).
+    """
+    brokers = list(brokers)
+    if not brokers:
+        return TradeTable()
+
+    def fetch(broker):
+        logger.info(f"Fetching options trades for {broker}")
+        return broker.get_options_trades(symbols, since=since, until=until)
+
+    workers = max(1, min(max_workers, len(brokers)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return TradeTable.concat(pool.map(fetch, brokers))
@@ -5,15 +5,18 @@ import ssl
 import urllib.parse
 import threading
 import webbrowser
-import json
+from array import array
 from decimal import Decimal
 import re
 import datetime
 import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-import dateutil.parser
-import pytz
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
 from thetalib.brokers.base import (
     AssetType,
@@ -22,9 +25,17 @@ from thetalib.brokers.base import (
     Instruction,
     OptionType,
     Trade,
+    TradeTable,
+    parallel_parse,
 )
 from thetalib.brokers.providers.selfsigned import generate_selfsigned_cert
+from thetalib.archive import SourceFileArchive, TransactionArchive
 from thetalib.config import get_user_data_dir
+from thetalib.jsonstream import iter_json_array
+from thetalib.httpcache import get_response_cache, is_fresh, request_key
+from thetalib.metrics import path_template, request_metrics
+from thetalib.profiling import iter_span, span
+from thetalib.store import TransactionStore
 
 
 logging.basicConfig(
@@ -36,11 +47,86 @@ logger = logging.getLogger(__name__)
 
 REDIRECT_URL = "https://127.0.0.1:42068/callback"
 
+# Max keep-alive connections kept open per host
+SESSION_POOL_SIZE = 10
+
+# Transaction history is requested in windows of this many days, up to
+# TRANSACTION_FETCH_WORKERS at a time. TD caps a single request at one
+# year.
+TRANSACTION_WINDOW_DAYS = 31
+TRANSACTION_FETCH_WORKERS = 8
+
+# Older history is synced backwards in blocks of this many days, until a
+# block without any transactions (or the broker config's "history_start"
+# date) is reached.
+HISTORY_BLOCK_DAYS = 365
+
+# Transactions can show up a little after the day they're dated (and TD's
+# days needn't be ours), so syncs go back over this many days before the
+# last day synced. The store dedupes by id.
+SYNC_OVERLAP_DAYS = 3
+
+# Version of the trades cached with raw archives. Bump it whenever parsing
+# changes, so that caches from before are parsed again.
+TRADE_CACHE_VERSION = 1
+
+# Access tokens are refreshed once they're this close (seconds) to
+# expiring, instead of waiting for TD to reject them.
+ACCESS_TOKEN_REFRESH_MARGIN = 5 * 60
+
+# When refreshing an access token, also ask for a new refresh token if the
+# current one expires within this many seconds.
+REFRESH_TOKEN_RENEW_MARGIN = 7 * 24 * 60 * 60
+
+# How long (seconds) cached GET responses are used without asking TD
+# again, by path template. Endpoints not listed aren't cached.
+CACHE_TTLS = {
+    '/v1/accounts': 5 * 60,
+    '/v1/accounts/{id}': 5 * 60,
+    '/v1/accounts/{id}/transactions': 5 * 60,
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """
+    Returns the pooled keep-alive requests.Session shared by everything
+    talking to url's host.
+    """
+    host = urllib.parse.urlparse(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(
+                pool_connections=1, pool_maxsize=SESSION_POOL_SIZE))
+            _sessions[host] = session
+    return session
+
 
 class TdAuthException(Exception):
     pass
 
 
+# Result of a token exchange. Times are epoch seconds. refresh_token and
+# refresh_expires_at are None unless a new refresh token was requested.
+TokenGrant = namedtuple(
+    'TokenGrant',
+    ['access_token', 'issued_at', 'expires_at', 'refresh_token',
+     'refresh_expires_at'],
+)
+
+
+def token_expiring(expires_at, margin=ACCESS_TOKEN_REFRESH_MARGIN):
+    """
+    True if a token expiring at expires_at (epoch seconds, None if
+    unknown) should be replaced now.
+    """
+    return expires_at is not None and time.time() >= expires_at - margin
+
+
 class TdAuth():
     TOKEN_URL = "https://api.tdameritrade.com/v1/oauth2/token"
 
@@ -53,11 +139,11 @@ class TdAuth():
         expires_at = None
         if refresh_token is None:
             refresh_token, expires_in = self.get_new_refresh_token()
-            expires_at = datetime.datetime.now(pytz.utc) \
+            expires_at = datetime.datetime.now(datetime.timezone.utc) \
                 + datetime.timedelta(seconds=expires_in)
             expires_at = int((expires_at).timestamp())
-        access_token = self.exchange_refresh_token(refresh_token)
-        return refresh_token, expires_at, access_token
+        grant = self.refresh_tokens(refresh_token)
+        return refresh_token, expires_at, grant
 
     def get_new_refresh_token(self):
         server = threading.Thread(target=self._start_server)
@@ -87,22 +173,38 @@ class TdAuth():
             'client_id': self._consumer_key,
             'redirect_uri': REDIRECT_URL,
         }
-        rsp = requests.post(TdAuth.TOKEN_URL, data=data)
+        rsp = get_session(TdAuth.TOKEN_URL).post(TdAuth.TOKEN_URL, data=data)
         rdata = rsp.json()
         return rdata['refresh_token'], rdata['refresh_token_expires_in']
 
-    def exchange_refresh_token(self, refresh_token):
+    def refresh_tokens(self, refresh_token, renew_refresh_token=False):
+        """
+        Exchanges refresh_token for a new access token. Returns a
+        TokenGrant, which also has a new refresh token if
+        renew_refresh_token.
+        """
         data = {
             'grant_type': 'refresh_token',
             'refresh_token': refresh_token,
-            'access_type': None,
+            'access_type': 'offline' if renew_refresh_token else None,
             'code': None,
             'client_id': self._consumer_key,
             'redirect_url': None,
         }
-        rsp = requests.post(TdAuth.TOKEN_URL, data=data)
+        issued_at = int(time.time())
+        rsp = get_session(TdAuth.TOKEN_URL).post(TdAuth.TOKEN_URL, data=data)
         data = rsp.json()
-        return data['access_token']
+        refresh_expires_in = data.get('refresh_token_expires_in')
+        return TokenGrant(
+            data['access_token'],
+            issued_at,
+            issued_at + data['expires_in'] if 'expires_in' in data else None,
+            data.get('refresh_token'),
+            issued_at + refresh_expires_in if refresh_expires_in else None,
+        )
+
+    def exchange_refresh_token(self, refresh_token):
+        return self.refresh_tokens(refresh_token).access_token
 
     def _start_server(self):
         # LOOK AWAY!!! D:
@@ -147,24 +249,213 @@ def get_access_tokens(consumer_key):
     return TdAuth(consumer_key).get_access_tokens()
 
 
+_token_grants = {}
+_token_grants_lock = threading.Lock()
+
+
+def refresh_access_token_shared(consumer_key, refresh_token,
+                                refresh_expires_at=None, stale_token=None):
+    """
+    Returns a TokenGrant for the given credentials, refreshing at most once
+    per process: brokers for several accounts usually share a consumer key
+    and refresh token, and get the grant the first of them obtained.
+
+    - refresh_expires_at :: When refresh_token expires (epoch seconds). A
+    new refresh token is requested along if it's close.
+    - stale_token :: Access token the caller knows to be bad. A cached
+    grant for it is never handed out.
+    """
+    key = (consumer_key, refresh_token)
+    with _token_grants_lock:
+        grant = _token_grants.get(key)
+        if (grant is not None and grant.access_token != stale_token
+                and not token_expiring(grant.expires_at)):
+            return grant
+        renew = token_expiring(refresh_expires_at,
+                               margin=REFRESH_TOKEN_RENEW_MARGIN)
+        grant = TdAuth(consumer_key).refresh_tokens(
+            refresh_token, renew_refresh_token=renew)
+        _token_grants[key] = grant
+        if grant.refresh_token:
+            _token_grants[(consumer_key, grant.refresh_token)] = grant
+        return grant
+
+
 class TdAPI:
+    """
+    Thin wrapper around the TD REST API.
+
+    - access_token :: Bearer token for requests.
+    - refresh_access_token :: Optional callable returning a TokenGrant
+    with a new access token. If given, the token is refreshed before
+    requests once it's about to expire, and a request that comes back 401
+    is retried once with a refreshed token.
+    - expires_at :: When access_token expires (epoch seconds), if known
+    - metrics :: RequestMetrics to record every request in (defaults to
+    the process-wide thetalib.metrics.request_metrics)
+    - cache :: Optional thetalib.httpcache.ResponseCache for GET
+    responses, see CACHE_TTLS
+    """
+
     API_BASE = 'https://api.tdameritrade.com'
 
-    def __init__(self, access_token):
+    def __init__(self, access_token, refresh_access_token=None,
+                 metrics=None, cache=None, expires_at=None):
         self._access_token = access_token
-
-    def _request(self, method, path):
-        headers = {"Authorization": f"Bearer {self._access_token}"}
-        fn = {
-            'get': requests.get,
-        }[method]
+        self._expires_at = expires_at
+        self._refresh_access_token = refresh_access_token
+        self._refresh_lock = threading.Lock()
+        self._session = get_session(TdAPI.API_BASE)
+        self._metrics = metrics or request_metrics
+        self._cache = cache
+
+    def _request(self, method, path, params=None, headers=None):
+        start = time.perf_counter()
+        status = None
+        retries = 0
+        rsp = None
+        try:
+            rsp, retries = self._send(method, path, params, headers)
+            status = rsp.status_code
+        finally:
+            latency_ms = (time.perf_counter() - start) * 1000
+            nbytes = len(rsp.content) if rsp is not None else 0
+            self._metrics.record(method, path, status, latency_ms, nbytes,
+                                 retries)
+            logger.debug(f"{method.upper()} {path} -> {status} in "
+                         f"{latency_ms:.1f} ms ({nbytes} bytes, "
+                         f"{retries} retries)")
+        if retries and status == 401:
+            logger.error("Couldn't get a working access_token D:")
+            raise TdAuthException()
+        return rsp
+
+    def _send(self, method, path, params, extra_headers=None):
+        """
+        Makes the request, retrying once with a new access token on 401.
+        Returns (response, retry count).
+        """
+        url = TdAPI.API_BASE + path
+        access_token = self._access_token
+        if self._refresh_access_token and token_expiring(self._expires_at):
+            self._refresh(access_token)
+            access_token = self._access_token
+        headers = {"Authorization": f"Bearer {access_token}",
+                   **(extra_headers or {})}
+        with span('http'):
+            rsp = self._session.request(method, url, headers=headers,
+                                        params=params)
+        if rsp.status_code == 401 and self._refresh_access_token:
+            self._refresh(access_token)
+            headers = {"Authorization": f"Bearer {self._access_token}",
+                       **(extra_headers or {})}
+            with span('http'):
+                rsp = self._session.request(method, url, headers=headers,
+                                            params=params)
+            return rsp, 1
+        return rsp, 0
+
+    def _refresh(self, stale_token):
+        with self._refresh_lock:
+            # Concurrent requests can all find the same token stale. Only
+            # the first one refreshes it.
+            if self._access_token == stale_token:
+                logger.info("Getting new access token")
+                grant = self._refresh_access_token()
+                self._access_token = grant.access_token
+                self._expires_at = grant.expires_at
+
+    def get(self, path, params=None, max_age=None):
+        """
+        GETs path. Responses of endpoints in CACHE_TTLS are served from the
+        cache while they're fresh, and revalidated with a conditional
+        request once they're stale (when TD gave us validators).
+
+        - max_age :: Overrides the endpoint's TTL, in seconds. 0 always
+        goes to TD, but still revalidates instead of re-downloading when
+        possible.
+        """
         if path[0] != '/':
             path = '/' + path
+        if max_age is None:
+            max_age = CACHE_TTLS.get(path_template(path))
+        if self._cache is None or max_age is None:
+            return self._request('get', path, params=params)
+
         url = TdAPI.API_BASE + path
-        return fn(url, headers=headers)
+        key = request_key('get', url, params)
+        entry = self._cache.get(key)
+        if entry is not None and is_fresh(entry, max_age):
+            self._metrics.record_cache_hit('get', path)
+            return _cached_response(entry, url)
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        rsp = self._request('get', path, params=params, headers=headers)
+        if rsp.status_code == 304 and entry is not None:
+            self._cache.touch(key)
+            return _cached_response(entry, url)
+        if rsp.status_code == 200:
+            self._cache.put(key, url, rsp.status_code, rsp.headers,
+                            rsp.content)
+        return rsp
+
+
+def _cached_response(entry, url):
+    rsp = requests.Response()
+    rsp.status_code = entry.status
+    rsp.headers = CaseInsensitiveDict(entry.headers)
+    rsp._content = entry.body
+    rsp.url = url
+    return rsp
+
+
+def date_windows(start, end, days):
+    """
+    Splits the inclusive date range [start, end] into consecutive,
+    non-overlapping inclusive (start, end) windows of at most days days.
+    """
+    windows = []
+    step = datetime.timedelta(days=days)
+    while start <= end:
+        window_end = min(start + step - datetime.timedelta(days=1), end)
+        windows.append((start, window_end))
+        start = window_end + datetime.timedelta(days=1)
+    return windows
 
-    def get(self, path):
-        return self._request('get', path)
+
+def parse_td_datetime(value):
+    """
+    Parses a TD timestamp like "2021-04-16T19:53:31+0000". TD always
+    sends this exact format, so we skip dateutil's generic parser unless
+    something unexpected shows up.
+    """
+    if len(value) == 24 and value[10] == 'T' and value[19] in '+-':
+        try:
+            # fromisoformat wants the offset as +HH:MM
+            return datetime.datetime.fromisoformat(
+                f'{value[:22]}:{value[22:]}')
+        except ValueError:
+            pass
+    import dateutil.parser
+    return dateutil.parser.parse(value)
+
+
+def parse_td_date(value):
+    """
+    Parses a TD date like "2021-04-19", falling back to dateutil.
+    """
+    if len(value) == 10:
+        try:
+            return datetime.date.fromisoformat(value)
+        except ValueError:
+            pass
+    import dateutil.parser
+    return dateutil.parser.parse(value).date()
 
 
 def option_symbol_parse_strike(option_symbol):
@@ -195,16 +486,16 @@ class TdTrade(Trade):
             option_symbol = None
         else:
             symbol = instrument['underlyingSymbol']
-            option_expiration = dateutil.parser.parse(
+            option_expiration = parse_td_datetime(
                 instrument['optionExpirationDate'])
             strike = option_symbol_parse_strike(instrument['symbol'])
             option_symbol = instrument['symbol']
 
         super().__init__(
             api_object,
-            dateutil.parser.parse(api_object['transactionDate']),
-            dateutil.parser.parse(api_object['orderDate']),
-            dateutil.parser.parse(api_object['settlementDate']).date(),
+            parse_td_datetime(api_object['transactionDate']),
+            parse_td_datetime(api_object['orderDate']),
+            parse_td_date(api_object['settlementDate']),
             self._get_instruction(),
             asset_type,
             self._get_option_type(asset_type),
@@ -218,6 +509,10 @@ class TdTrade(Trade):
             option_symbol,
         )
 
+    @property
+    def transaction_id(self):
+        return self.api_object['transactionId']
+
     def _get_instruction(self):
         instruction = self.api_object['transactionItem']['instruction']
         if instruction == 'BUY':
@@ -250,6 +545,15 @@ class TdTrade(Trade):
         return sum(Decimal(str(f)) for f in self.api_object['fees'].values())
 
 
+def parse_td_trades(transactions):
+    """
+    Parses TRADE transactions into a TradeTable without api_objects. Used
+    as the parallel_parse worker.
+    """
+    return TradeTable.from_trades(map(TdTrade, transactions),
+                                  keep_api_objects=False)
+
+
 class BrokerTd(Broker):
     """
     Broker class for TD.
@@ -257,57 +561,375 @@ class BrokerTd(Broker):
 
     provider_name = "td"
 
+    # Where raw transaction archives (and export file indexes) are kept.
+    # None for the archive dir in the user data dir.
+    archive_dir = None
+
     def __init__(self, config, test_file=None):
         super().__init__()
         self.config = config
         self.account_name = config['name']
 
-        self._test_data = None
+        # Trades look their raw transactions up here when asked, rather
+        # than keeping them all in memory. Opened on first use.
+        self._raw_archive = None
+
         self._test_file = test_file
         if test_file is not None:
-            with open(os.path.expanduser(test_file)) as f:
-                self._test_data = json.loads(f.read())
             return
 
         self._api = self._init_api()
 
         self._trades = None
-        # TODO: check if config['data']['refresh_expires_at'] is coming
-        # up, and if so, get a new refresh token.
+
+    def _get_raw_archive(self):
+        archive = self._raw_archive
+        if self._test_file is not None:
+            # Export files are read in place, and indexed again once they
+            # change
+            if archive is None or not archive.is_current():
+                archive = SourceFileArchive(self._test_file,
+                                            directory=self.archive_dir)
+        elif archive is None:
+            account_id = self.config['data']['account_id']
+            archive = TransactionArchive(f'{self.provider_name}-{account_id}',
+                                         directory=self.archive_dir)
+        self._raw_archive = archive
+        return archive
+
+    def _init_seen(self):
+        # Day (YYYY-MM-DD) of the newest transaction seen so far, and the
+        # ids of the transactions seen on that day. Polls re-read that day,
+        # since that's as fine as TD can filter.
+        self._seen_day = None
+        self._seen_ids = set()
+
+    def _track_seen(self, transactions):
+        for t in transactions:
+            day = t['transactionDate'][:10]
+            if self._seen_day is None or day > self._seen_day:
+                self._seen_day = day
+                self._seen_ids = set()
+            if day == self._seen_day:
+                self._seen_ids.add(t['transactionId'])
+            yield t
+
+    def _is_unseen(self, transaction):
+        day = transaction['transactionDate'][:10]
+        return (self._seen_day is None or day > self._seen_day
+                or (day == self._seen_day
+                    and transaction['transactionId'] not in self._seen_ids))
 
     def _init_api(self):
-        api = TdAPI(self.config['data']['access_token'])
-        if api.get('/v1/accounts').status_code != 200:
-            logger.info("Getting new access token")
-            ckey = self.config['data']['consumer_key']
-            rtoken = self.config['data']['refresh_token']
-            access_token = TdAuth(ckey).exchange_refresh_token(rtoken)
-            self.config['data']['access_token'] = access_token
-            api = TdAPI(access_token)
-            if api.get('/v1/accounts').status_code != 200:
-                logger.error("Couldn't get a working access_token D:")
-                raise TdAuthException()
-        return api
+        # No auth round trips here. The stored token is used as long as its
+        # recorded expiry is far enough away (or unknown), and TdAPI
+        # refreshes it right before the first request otherwise. Refresh
+        # tokens are renewed along when they get close to expiring, see
+        # refresh_access_token_shared.
+        data = self.config['data']
+        with span('auth'):
+            return TdAPI(data['access_token'],
+                         refresh_access_token=self._refresh_access_token,
+                         cache=get_response_cache(),
+                         expires_at=data.get('access_token_expires_at'))
+
+    def _refresh_access_token(self):
+        data = self.config['data']
+        with span('auth'):
+            grant = refresh_access_token_shared(
+                data['consumer_key'],
+                data['refresh_token'],
+                refresh_expires_at=data.get('refresh_expires_at'),
+                stale_token=data['access_token'],
+            )
+        data['access_token'] = grant.access_token
+        data['access_token_issued_at'] = grant.issued_at
+        data['access_token_expires_at'] = grant.expires_at
+        if grant.refresh_token:
+            data['refresh_token'] = grant.refresh_token
+            data['refresh_expires_at'] = grant.refresh_expires_at
+        self.config_changed()
+        return grant
+
+    def _iter_test_transactions(self):
+        """
+        Streams transactions from the test/export file one at a time. The
+        first pass over a new or changed file also records where each
+        transaction is in it, which is what the file's archive looks them
+        up by.
+        """
+        archive = self._get_raw_archive()
+        with open(archive.data_path, encoding='utf-8', newline='') as f:
+            if archive.is_indexed():
+                yield from iter_span('json_decode', iter_json_array(f))
+                return
+            entries = array('q')
+            for t, offset, length in iter_span(
+                    'json_decode', iter_json_array(f, offsets=True)):
+                entries.extend((t['transactionId'], offset, length))
+                yield t
+        with span('archive'):
+            archive.write_index(
+                entries[i:i + 3] for i in range(0, len(entries), 3))
+
+    def _fetch_transactions(self, start_date, end_date, max_age=None):
+        """
+        Requests transactions between start_date and end_date (inclusive)
+        from TD. Long ranges are split into date windows which are fetched
+        concurrently, then merged in order and deduplicated by
+        transactionId. max_age is passed on to TdAPI.get.
+        """
+        account_id = self.config['data']['account_id']
+        url = f'/v1/accounts/{account_id}/transactions'
+        windows = date_windows(start_date, end_date, TRANSACTION_WINDOW_DAYS)
+
+        def fetch(window):
+            rsp = self._api.get(url, params={
+                'startDate': window[0].isoformat(),
+                'endDate': window[1].isoformat(),
+            }, max_age=max_age)
+            rsp.raise_for_status()
+            with span('json_decode'):
+                return rsp.json()
+
+        workers = max(1, min(TRANSACTION_FETCH_WORKERS, len(windows)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(fetch, windows))
+
+        transactions = []
+        seen = set()
+        for chunk in chunks:
+            for t in sorted(chunk, key=lambda t: t['transactionDate']):
+                if t['transactionId'] not in seen:
+                    seen.add(t['transactionId'])
+                    transactions.append(t)
+        return transactions
 
     def _get_transactions(self):
-        if self._test_data:
-            return self._test_data
+        """
+        Returns all raw transactions for this account, oldest first.
+        Transactions are kept in the raw archive, with the local
+        TransactionStore recording what has been synced, so only the
+        window since the last sync is requested from TD.
+        """
+        if self._test_file is not None:
+            return self._iter_test_transactions()
         account_id = self.config['data']['account_id']
-        url = f'/v1/accounts/{account_id}/transactions'
-        return self._api.get(url).json()
+        archive = self._get_raw_archive()
+        store = TransactionStore()
+        try:
+            with span('store'):
+                synced = len(store.get_transaction_ids(self.provider_name,
+                                                       account_id))
+            if len(archive) < synced:
+                # The archive was deleted (or lost transactions), so what
+                # the store says was synced can't be read back. Start over.
+                logger.info(f"Raw archive of {self.account_name} is "
+                            f"incomplete, syncing again")
+                store.forget_account(self.provider_name, account_id)
+            state = store.get_sync_state(self.provider_name, account_id)
+            if state is not None:
+                self._sync_store(store, parse_td_date(state.synced_through)
+                                 - datetime.timedelta(days=SYNC_OVERLAP_DAYS))
+            self._sync_history(store)
+            with span('store'):
+                ids = [int(tid) for tid in store.get_transaction_ids(
+                    self.provider_name, account_id)]
+        finally:
+            store.close()
+        return iter_span('json_decode', archive.iter_transactions(ids))
+
+    def _sync_history(self, store):
+        """
+        Syncs the account's history, starting from today and walking back
+        in blocks of HISTORY_BLOCK_DAYS until the configured history_start
+        is reached, or without one, until a block comes back empty. Does
+        nothing once the whole history has been synced.
+        """
+        account_id = self.config['data']['account_id']
+        history = store.get_history_state(self.provider_name, account_id)
+        if history is not None and history.complete:
+            return
+        if history is not None:
+            synced_from = parse_td_date(history.synced_from)
+        else:
+            synced_from = datetime.date.today() + datetime.timedelta(days=1)
+        limit = self.config['data'].get('history_start')
+        limit = parse_td_date(limit) if limit else None
+
+        while True:
+            end_date = synced_from - datetime.timedelta(days=1)
+            start_date = end_date - datetime.timedelta(
+                days=HISTORY_BLOCK_DAYS - 1)
+            if limit is not None:
+                start_date = max(start_date, limit)
+            if start_date > end_date:
+                complete = True
+            else:
+                transactions = self._sync_store(store, start_date, end_date)
+                synced_from = start_date
+                if limit is not None:
+                    complete = start_date == limit
+                else:
+                    complete = not transactions
+                    if complete:
+                        self._warn_history_gap(start_date, end_date)
+            store.set_history_state(self.provider_name, account_id,
+                                    synced_from.isoformat(), complete)
+            if complete:
+                return
+
+    def _warn_history_gap(self, start_date, end_date):
+        # Anything before the gap is left out for good, so don't leave
+        # that to the log
+        message = (
+            f"{self.account_name}: TD has no transactions from {start_date} "
+            f"to {end_date}, so older history wasn't synced. If the "
+            f"account has older transactions, set \"history_start\" "
+            f"(YYYY-MM-DD) in its config to sync back to that date.")
+        logger.warning(message)
+        print(f"Warning: {message}", file=sys.stderr)
+
+    def _sync_store(self, store, start_date, end_date=None, max_age=None):
+        """
+        Fetches transactions from start_date until end_date (today by
+        default) into the raw archive, and records them in store along
+        with the synced window (even if it was empty). Returns the
+        fetched transactions.
+        """
+        account_id = self.config['data']['account_id']
+        end_date = end_date or datetime.date.today()
+        transactions = self._fetch_transactions(start_date, end_date,
+                                                max_age=max_age)
+        logger.info(f"Got {len(transactions)} new transactions "
+                    f"for {self.account_name}")
+        # Archive first, so the store never records a transaction that
+        # isn't there to be read back
+        with span('archive'):
+            self._get_raw_archive().append(transactions)
+        with span('store'):
+            store.merge_transactions(self.provider_name, account_id, (
+                (t['transactionId'], t['transactionDate'])
+                for t in transactions
+            ), synced_through=end_date.isoformat())
+        return transactions
+
+    def _parse_trades(self, transactions):
+        # Raw transactions aren't kept with the trades, they're loaded
+        # from the archive on demand
+        trades = (t for t in transactions if t['type'] == 'TRADE')
+        with span('parse'):
+            if self.parse_workers == 1:
+                table = parse_td_trades(trades)
+            else:
+                table = parallel_parse(parse_td_trades, trades,
+                                       self.parse_workers,
+                                       keep_api_objects=False)
+        table.raw_archive = self._get_raw_archive()
+        return table
+
+    def _load_trades(self):
+        """
+        Returns all trades, tracking the seen transactions along the way.
+
+        Parsed trades are cached with the raw archive, so a run only has
+        to parse the transactions archived since the last one. Everything
+        is parsed again if there's no usable cache, or if the new
+        transactions don't simply follow the cached ones: one of them is
+        an update of a cached transaction, or goes before cached trades.
+        """
+        transactions = self._get_transactions()
+        archive = self._get_raw_archive()
+        with span('trade_cache'):
+            cache = archive.load_trade_cache()
+        table = None
+        if cache is not None and cache.get('version') == TRADE_CACHE_VERSION \
+                and cache['columns'] == TradeTable.COLUMNS:
+            table = self._extend_cached(archive, cache)
+        if table is None:
+            self._init_seen()
+            table = self._parse_trades(self._track_seen(transactions))
+        entries = archive.entry_count()
+        if cache is None or table is not cache['table'] \
+                or entries != cache['entries']:
+            with span('trade_cache'):
+                archive.save_trade_cache({
+                    'version': TRADE_CACHE_VERSION,
+                    'columns': TradeTable.COLUMNS,
+                    'entries': entries,
+                    'table': table,
+                    'seen': (self._seen_day, self._seen_ids),
+                })
+        table.raw_archive = archive
+        return table
+
+    def _extend_cached(self, archive, cache):
+        """
+        Returns the cached trades with those of the transactions archived
+        since appended, or None if that's not possible.
+        """
+        table = cache['table']
+        if cache['entries'] > archive.entry_count():
+            # Not the archive the cache was built from
+            return None
+        self._seen_day, self._seen_ids = cache['seen']
+        new = list(archive.iter_entries(cache['entries']))
+        if not new:
+            return table
+        new_ids = {tid for tid, _ in new}
+        if len(new_ids) < len(new) or not new_ids.isdisjoint(
+                table.transaction_id):
+            return None
+        new_table = self._parse_trades(
+            self._track_seen(t for _, t in new))
+        if len(new_table) and len(table) \
+                and min(new_table.transaction_ts) < max(table.transaction_ts):
+            return None
+        if len(new_table):
+            table.extend(new_table)
+        return table
 
     def provider_get_trades(self, symbols=None, since=None):
         if self._trades is None:
-            self._trades = [
-                TdTrade(t)
-                for t in self._get_transactions() if t['type'] == 'TRADE'
-            ]
+            self._trades = self._load_trades()
         return self._trades
 
+    def provider_get_new_trades(self):
+        if self._trades is None:
+            self.provider_get_trades()
+            return self._parse_trades([])
+        if self._test_file is not None:
+            # Nothing can be new as long as the file hasn't changed
+            transactions = [] if self._raw_archive.is_current() \
+                else self._iter_test_transactions()
+        else:
+            store = TransactionStore()
+            try:
+                if self._seen_day is not None:
+                    start_date = parse_td_date(self._seen_day)
+                else:
+                    # No transactions yet: pick up where the last sync
+                    # left off
+                    state = store.get_sync_state(
+                        self.provider_name, self.config['data']['account_id'])
+                    start_date = parse_td_date(state.synced_through) \
+                        if state is not None else datetime.date.today()
+                    start_date -= datetime.timedelta(days=SYNC_OVERLAP_DAYS)
+                # Polling is all about fresh data, so don't let the HTTP
+                # cache answer. It can still revalidate instead of
+                # re-downloading.
+                transactions = self._sync_store(store, start_date, max_age=0)
+            finally:
+                store.close()
+        new_trades = self._parse_trades(self._track_seen(
+            [t for t in transactions if self._is_unseen(t)]))
+        self._trades.extend(new_trades)
+        return new_trades
+
     @classmethod
     def from_config(cls, config):
         if "file" in config["data"]:
-            return cls(None, test_file=config["data"]["file"])
+            return cls(config, test_file=config["data"]["file"])
         return cls(config)
 
     def to_config_data(self):
@@ -334,11 +956,13 @@ class BrokerTd(Broker):
             print("[1] https://developer.tdameritrade.com/content/getting-started")
             print()
             consumer_key = input(" >> ")
-            (refresh_token, refresh_expires_at, access_token) \
+            (refresh_token, refresh_expires_at, grant) \
                 = get_access_tokens(consumer_key)
+            access_token = grant.access_token
         else:
             print("Please enter your TD API access token:")
             access_token = input(" >> ")
+            grant = None
 
         if os.path.isfile(os.path.expanduser(access_token)):
             return cls.from_config({"data": {"file": access_token},
@@ -363,6 +987,9 @@ class BrokerTd(Broker):
             "account_id": account["securitiesAccount"]["accountId"],
             "consumer_key": consumer_key,
         }
+        if grant is not None:
+            config_data["access_token_issued_at"] = grant.issued_at
+            config_data["access_token_expires_at"] = grant.expires_at
         return cls.from_config({"data": config_data, "name": account_name})
 
 
@@ -2,6 +2,9 @@ import os
 import json
 import appdirs
 import errno
+import threading
+
+from thetalib.profiling import span
 
 
 """
@@ -24,7 +27,9 @@ class UserConfig:
     User configuration serialization/deserialization.
 
     - brokers :: List of Broker objects parsed and initialized from the
-    saved config.
+    saved config. Brokers (and their provider modules) are only loaded
+    the first time this is accessed. Config changes brokers make on their
+    own (like refreshed tokens) are persisted right away.
     """
 
     @staticmethod
@@ -33,8 +38,6 @@ class UserConfig:
         return os.path.join(config_dir, 'config.json')
 
     def __init__(self):
-        from thetalib.brokers import get_broker_providers
-
         self._config_path = self._get_config_path()
 
         try:
@@ -49,16 +52,56 @@ class UserConfig:
         except FileNotFoundError:
             self.data = {'brokers': []}
 
-        providers = get_broker_providers()
-        self.brokers = []
-        for broker_cfg in self.data['brokers']:
-            provider = providers.get(broker_cfg['provider'])
-            if provider:
-                self.brokers.append(provider.from_config(broker_cfg))
+        self._brokers = None
+        self._persist_lock = threading.Lock()
+        self._mtime = self._get_mtime()
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self._config_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def changed_on_disk(self):
+        """
+        True if the config file was changed by someone else since we
+        loaded or persisted it.
+        """
+        return self._get_mtime() != self._mtime
+
+    @property
+    def brokers(self):
+        if self._brokers is None:
+            with span('brokers'):
+                from thetalib.brokers import get_broker_providers
+
+                providers = get_broker_providers()
+                self._brokers = []
+                for broker_cfg in self.data['brokers']:
+                    provider = providers.get(broker_cfg['provider'])
+                    if provider:
+                        broker = provider.from_config(broker_cfg)
+                        broker.on_config_change = self._broker_changed
+                        self._brokers.append(broker)
+        return self._brokers
+
+    @property
+    def loaded_brokers(self):
+        """
+        Brokers that have been initialized so far, without initializing
+        the rest.
+        """
+        return self._brokers or []
+
+    def _broker_changed(self, broker):
+        self.persist()
 
     def persist(self):
-        with open(self._config_path, 'w+') as f:
-            f.write(json.dumps(self.data))
+        # Brokers can be persisting from several threads at once
+        with self._persist_lock:
+            with open(self._config_path, 'w+') as f:
+                f.write(json.dumps(self.data))
+            self._mtime = self._get_mtime()
 
     def get_broker_config_by_name(self, name):
         for broker_cfg in self.data['brokers']:
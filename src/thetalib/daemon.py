@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+
+from thetalib.config import get_user_config, get_user_data_dir
+
+
+"""
+Resident server for thetactl.
+
+`thetactl daemon` loads the config once and keeps its brokers around,
+along with everything they hold on to: API sessions and tokens, parsed
+trades and trade indexes. Commands run from the CLI connect to it over a
+Unix socket and get the command's output streamed back, so they don't pay
+for startup, auth, syncing and parsing every time.
+
+Protocol: the client sends one JSON line, {"argv": [...]}. The server
+runs the command and replies with JSON lines of {"stdout": text},
+{"stderr": text} and finally {"exit": code}.
+"""
+
+
+SOCKET_NAME = 'thetactl.sock'
+
+# Before running a command, the daemon tops up the trades it holds with
+# new ones from the brokers (see Broker.refresh_trades) if it hasn't done
+# so for this many seconds.
+TRADES_REFRESH_INTERVAL = 60
+
+
+def get_socket_path():
+    return os.path.join(get_user_data_dir(), SOCKET_NAME)
+
+
+class _StreamWriter:
+    """
+    File-like object sending everything written to it to the client as
+    {name: text} messages.
+    """
+
+    def __init__(self, wfile, name):
+        self._wfile = wfile
+        self._name = name
+
+    def write(self, text):
+        if text:
+            _send(self._wfile, {self._name: text})
+        return len(text)
+
+    def flush(self):
+        self._wfile.flush()
+
+    def isatty(self):
+        return False
+
+
+def _send(wfile, message):
+    wfile.write(json.dumps(message).encode() + b'\n')
+
+
+class _Server:
+    def __init__(self, run_command):
+        self._run_command = run_command
+        self._config = get_user_config()
+        self._trades_refreshed_at = time.monotonic()
+
+    def _refresh(self):
+        if self._config.changed_on_disk():
+            # Brokers were added or removed behind our back
+            self._config = get_user_config()
+            self._trades_refreshed_at = time.monotonic()
+        elif (time.monotonic() - self._trades_refreshed_at
+              > TRADES_REFRESH_INTERVAL):
+            # Only brokers whose trades were loaded have any to refresh,
+            # so this doesn't go to brokers no command has used yet
+            for broker in self._config.loaded_brokers:
+                broker.refresh_trades()
+            self._trades_refreshed_at = time.monotonic()
+
+    def handle(self, conn):
+        import contextlib
+
+        rfile = conn.makefile('rb')
+        wfile = conn.makefile('wb')
+        try:
+            line = rfile.readline()
+            if not line:
+                # Just checking whether we're alive
+                return
+            request = json.loads(line)
+            code = 0
+            with contextlib.redirect_stdout(_StreamWriter(wfile, 'stdout')), \
+                    contextlib.redirect_stderr(_StreamWriter(wfile, 'stderr')):
+                try:
+                    # In here, so that a failed sync is reported to the
+                    # client rather than taking the daemon down
+                    self._refresh()
+                    self._run_command(self._config, request['argv'])
+                except SystemExit as e:
+                    if isinstance(e.code, str):
+                        print(e.code, file=sys.stderr)
+                        code = 1
+                    else:
+                        code = e.code or 0
+                except Exception as e:
+                    print(f"thetactl daemon: {e!r}", file=sys.stderr)
+                    code = 1
+            _send(wfile, {'exit': code})
+            wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away (e.g. its output was piped into head)
+            pass
+        finally:
+            rfile.close()
+            try:
+                wfile.close()
+            except OSError:
+                # Output still buffered for a client that's gone
+                pass
+
+
+def _socket_in_use(path):
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+        return True
+
+
+def serve(run_command, socket_path=None):
+    """
+    Runs the daemon until interrupted. run_command(config, argv) runs a
+    single thetactl command line, writing to sys.stdout/sys.stderr.
+    Commands are handled one at a time.
+    """
+    import signal
+    import socket
+
+    path = socket_path or get_socket_path()
+    if os.path.exists(path):
+        if _socket_in_use(path):
+            print(f"A thetactl daemon is already listening on {path}")
+            sys.exit(1)
+        os.unlink(path)
+
+    server = _Server(run_command)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the current user may talk to the daemon
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+    sock.listen()
+    # Clean up the socket on kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"thetactl daemon listening on {path}")
+    try:
+        while True:
+            conn, _ = sock.accept()
+            with conn:
+                server.handle(conn)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.unlink(path)
+
+
+def run_client(argv, socket_path=None):
+    """
+    Runs argv on the daemon, copying its output to our stdout/stderr.
+    Returns the command's exit code, or None if no daemon is running.
+    """
+    path = socket_path or get_socket_path()
+    if not os.path.exists(path):
+        return None
+    # Imported this late so that CLI runs pay for socket only when there's
+    # a daemon to talk to (the same goes for the other lazy imports here)
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rb') as rfile:
+        sock.sendall(json.dumps({'argv': argv}).encode() + b'\n')
+        for line in rfile:
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            out = sys.stdout if 'stdout' in message else sys.stderr
+            try:
+                out.write(message.get('stdout', message.get('stderr')))
+                out.flush()
+            except BrokenPipeError:
+                # Same as running locally: our reader went away
+                os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+                return 1
+    print("Lost connection to the thetactl daemon", file=sys.stderr)
+    return 1
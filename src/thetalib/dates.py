@@ -0,0 +1,101 @@
+import re
+import datetime
+import functools
+
+
+"""
+Resolution of user-supplied date expressions (--since/--until) to epoch
+microseconds in the local timezone.
+
+ISO dates and the common "N units ago" phrases are handled here directly;
+anything else goes through dateparser, which is slow to import and to
+call, so its results are memoized per (expression, current date).
+"""
+
+
+_ISO_RE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{2}):(\d{2})(?::(\d{2}))?)?$')
+_AGO_RE = re.compile(
+    r'^(\d+|an?)\s+(second|minute|hour|day|week|month|year)s?\s+ago$')
+
+_DAYS_AGO = {
+    'now': 0,
+    'today': 0,
+    'yesterday': 1,
+}
+
+
+def _months_ago(now, months):
+    month_index = now.year * 12 + now.month - 1 - months
+    year, month = divmod(month_index, 12)
+    month += 1
+    # Clamp the day to the end of the target month (Mar 31 -> Feb 28)
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    last_day = (next_month - datetime.timedelta(days=1)).day
+    return now.replace(year=year, month=month, day=min(now.day, last_day))
+
+
+def parse_fast(expr, now=None):
+    """
+    Parses ISO dates ("2021-02-01", "2021-02-01 10:30") and simple
+    relative phrases ("today", "yesterday", "3 weeks ago") to a naive
+    local datetime. Relative phrases keep the current time of day, like
+    dateparser does. Returns None for anything else.
+    """
+    expr = expr.strip().lower()
+    match = _ISO_RE.match(expr)
+    if match:
+        parts = [int(p) if p else 0 for p in match.groups()]
+        try:
+            return datetime.datetime(*parts)
+        except ValueError:
+            return None
+
+    if now is None:
+        now = datetime.datetime.now()
+    if expr in _DAYS_AGO:
+        return now - datetime.timedelta(days=_DAYS_AGO[expr])
+
+    match = _AGO_RE.match(expr)
+    if not match:
+        return None
+    count, unit = match.groups()
+    count = 1 if count in ('a', 'an') else int(count)
+    if unit == 'month':
+        return _months_ago(now, count)
+    if unit == 'year':
+        return _months_ago(now, count * 12)
+    return now - datetime.timedelta(**{f'{unit}s': count})
+
+
+def _to_ts(naive):
+    # astimezone() on a naive datetime interprets it as local time
+    aware = naive.astimezone()
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return (aware - epoch) // datetime.timedelta(microseconds=1)
+
+
+@functools.lru_cache(maxsize=256)
+def _resolve_slow(expr, today):
+    # today is only part of the cache key, so that relative phrases are
+    # re-resolved when the date changes.
+    import dateparser
+
+    parsed = dateparser.parse(expr)
+    if parsed is None:
+        raise ValueError(f"Couldn't understand date: {expr}")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return _to_ts(parsed)
+
+
+def resolve_date_expression(expr):
+    """
+    Returns the epoch microseconds (see
+    thetalib.brokers.base.datetime_to_ts) for a date expression,
+    interpreted in the local timezone.
+    """
+    parsed = parse_fast(expr)
+    if parsed is not None:
+        return _to_ts(parsed)
+    return _resolve_slow(expr, datetime.date.today())
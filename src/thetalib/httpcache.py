@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import namedtuple
+
+from thetalib.config import get_user_data_dir
+
+
+"""
+Disk-backed cache of API responses, so that running the same report again
+shortly afterwards doesn't transfer anything.
+
+Entries are keyed by request (method, url, params). Callers decide how
+long an entry stays fresh; once it's stale it can be revalidated with a
+conditional request (If-None-Match / If-Modified-Since) if the server
+gave us an ETag or Last-Modified. For servers that don't, a content hash
+is kept so that identical responses only refresh the entry instead of
+rewriting it. The cache is bounded in size, evicting least recently used
+entries first.
+"""
+
+
+# Cache size limit (response bodies), in bytes
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Response headers worth keeping with a cached body
+KEPT_HEADERS = ('content-type', 'etag', 'last-modified', 'date')
+
+CachedResponse = namedtuple(
+    'CachedResponse',
+    ['status', 'headers', 'body', 'etag', 'last_modified', 'content_hash',
+     'stored_at'],
+)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_by_access
+    ON responses (accessed_at);
+"""
+
+
+def request_key(method, url, params=None):
+    """
+    Returns the cache key for a request. params order doesn't matter.
+    """
+    params = sorted((params or {}).items())
+    return hashlib.sha256(
+        json.dumps([method.upper(), url, params]).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache. Safe to share between threads.
+
+    - path :: Location of the SQLite database. Defaults to
+    http_cache.sqlite3 in the user data dir.
+    - max_bytes :: Total size of cached bodies to keep
+    """
+
+    @staticmethod
+    def _get_cache_path():
+        return os.path.join(get_user_data_dir(), 'http_cache.sqlite3')
+
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES):
+        self._path = path or self._get_cache_path()
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self._path, timeout=30,
+                                     check_same_thread=False)
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, key):
+        """
+        Returns the CachedResponse for key (fresh or not), or None.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT status, headers, body, etag, last_modified, "
+                "content_hash, stored_at FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        status, headers, body, etag, last_modified, chash, stored_at = row
+        return CachedResponse(status, json.loads(headers), body, etag,
+                              last_modified, chash, stored_at)
+
+    def put(self, key, url, status, headers, body):
+        """
+        Stores a response. headers is a case-insensitive mapping of the
+        response headers. If the body is identical to the cached one the
+        entry is only marked as fresh.
+        """
+        content_hash = hashlib.sha256(body).hexdigest()
+        now = time.time()
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                "UPDATE responses SET stored_at = ?, accessed_at = ? "
+                "WHERE key = ? AND content_hash = ?",
+                (now, now, key, content_hash),
+            ).rowcount
+            if updated:
+                return
+            kept = {h: headers[h] for h in KEPT_HEADERS if h in headers}
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, url, status, "
+                "headers, body, etag, last_modified, content_hash, size, "
+                "stored_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url, status, json.dumps(kept), body,
+                 kept.get('etag'), kept.get('last-modified'), content_hash,
+                 len(body), now, now),
+            )
+            self._evict()
+
+    def touch(self, key):
+        """
+        Marks an entry as fresh, after the server confirmed it's still
+        valid.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE responses SET stored_at = ?, accessed_at = ? "
+                "WHERE key = ?",
+                (now, now, key),
+            )
+
+    def _evict(self):
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for key, size in self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at"):
+            if total <= self.max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?",
+                               victims)
+
+
+def is_fresh(entry: CachedResponse, max_age):
+    return time.time() - entry.stored_at < max_age
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Returns the ResponseCache shared by the whole process.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
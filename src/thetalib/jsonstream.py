@@ -0,0 +1,102 @@
+import json
+
+
+# Number of characters read from the file at a time
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',]'
+
+
+def _utf8_len(text):
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+def iter_json_array(f, chunk_size=CHUNK_SIZE, offsets=False):
+    """
+    Yields the elements of the top-level JSON array in file object f one
+    at a time, without ever decoding (or reading) the whole document at
+    once. Memory use is bounded by the largest single element.
+
+    With offsets=True, yields (element, offset, length) tuples instead,
+    locating each element's JSON text in the file in bytes. f must then
+    be opened with encoding='utf-8' and newline='' (so that line endings
+    aren't translated).
+
+    Raises ValueError if the document isn't a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    # Byte offset in the file of buf[pos] (assuming UTF-8), for offsets
+    # and error messages
+    offset = 0
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    while True:
+        start = pos
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        offset += pos - start
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            fill()
+            continue
+
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError("Expected a JSON array")
+            started = True
+            expect_value = True
+            after_comma = False
+            pos += 1
+            offset += 1
+            continue
+
+        if buf[pos] == ']':
+            if after_comma:
+                raise ValueError(f"Expected a value at offset {offset}")
+            return
+        if not expect_value:
+            if buf[pos] != ',':
+                raise ValueError(f"Expected ',' or ']' at offset {offset}")
+            expect_value = True
+            after_comma = True
+            pos += 1
+            offset += 1
+            continue
+
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if eof:
+                # e.pos is relative to the buffer
+                raise ValueError(
+                    f"{e.msg} at offset "
+                    f"{offset + _utf8_len(buf[pos:e.pos])}") from None
+            fill()
+            continue
+        if not eof and (end == len(buf) or buf[end] not in _DELIMITERS):
+            # A number cut off by the end of the buffer decodes fine but
+            # might continue in the next chunk.
+            fill()
+            continue
+        length = _utf8_len(buf[pos:end])
+        if offsets:
+            yield value, offset, length
+        else:
+            yield value
+        offset += length
+        expect_value = False
+        after_comma = False
+        pos = end
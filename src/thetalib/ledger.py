@@ -0,0 +1,271 @@
+import datetime
+from array import array
+
+from thetalib.brokers.base import (
+    Instruction,
+    OptionType,
+    PositionEffect,
+    TradeTable,
+    TradeView,
+    ts_to_datetime,
+)
+
+
+"""
+Single-pass position ledger for options trades.
+
+The ledger walks each symbol's trades once, in time order, and keeps
+running state per option symbol (open interest by leg, realized P&L,
+first/last trade, expiry) and per underlying symbol (running P&L, calls
+vs puts P&L). Money is accumulated as PRICE_SCALE fixed-point integers;
+renderers convert to Decimal (see thetalib.brokers.base.from_fixed) only
+for display.
+"""
+
+
+_CALL = OptionType.CALL.value
+
+
+def trades_by_symbol(trades: TradeTable):
+    """
+    Yields (symbol, trades) sorted by symbol, with each symbol's trades
+    sorted by time.
+    """
+    if trades.symbol_ordered:
+        yield from trades.symbol_runs()
+        return
+    by_symbol = {
+        trades.symbols[symbol_id]: group
+        for symbol_id, group in trades.group_by('symbol_id').items()
+    }
+    for symbol, group in sorted(by_symbol.items(), key=lambda el: el[0]):
+        yield symbol, group.sort_by('transaction_ts')
+
+
+def transition_code(instruction_code, option_type_code,
+                    position_effect_code):
+    """
+    Packs a trade's enum codes (each 0-2, 0 meaning None) into a single
+    code in range(27), used to index LEG_TRANSITIONS.
+    """
+    return instruction_code * 9 + option_type_code * 3 + position_effect_code
+
+
+def _build_leg_transitions():
+    # (instruction, option type, position effect) -> sign of the change to
+    # (long calls, short calls, long puts, short puts). Any combination not
+    # listed (equities, missing enums) doesn't move open interest.
+    buy, sell = Instruction.BUY, Instruction.SELL
+    call, put = OptionType.CALL, OptionType.PUT
+    opening, closing = PositionEffect.OPEN, PositionEffect.CLOSE
+    transitions = {
+        (buy, call, opening): (1, 0, 0, 0),
+        (buy, call, closing): (0, -1, 0, 0),
+        (buy, put, opening): (0, 0, 1, 0),
+        (buy, put, closing): (0, 0, 0, -1),
+        (sell, call, opening): (0, 1, 0, 0),
+        (sell, call, closing): (-1, 0, 0, 0),
+        (sell, put, opening): (0, 0, 0, 1),
+        (sell, put, closing): (0, 0, -1, 0),
+    }
+    table = [(0, 0, 0, 0)] * 27
+    for (ins, otype, effect), signs in transitions.items():
+        table[transition_code(ins.value, otype.value, effect.value)] = signs
+    return tuple(table)
+
+
+# Leg transition table indexed by transition_code()
+LEG_TRANSITIONS = _build_leg_transitions()
+
+# The same table split into one column per leg, for gathers over a column
+# of transition codes.
+LEG_SIGN_COLUMNS = tuple(zip(*LEG_TRANSITIONS))
+
+
+def leg_deltas(instruction_code, option_type_code, position_effect_code,
+               quantity):
+    """
+    Returns the (long calls, short calls, long puts, short puts) open
+    interest change caused by a trade.
+    """
+    signs = LEG_TRANSITIONS[transition_code(
+        instruction_code, option_type_code, position_effect_code)]
+    return tuple(sign * quantity for sign in signs)
+
+
+def transition_codes(trades: TradeTable):
+    """
+    Returns an array of transition_code() for every row of trades.
+    """
+    return array('b', (
+        ins * 9 + otype * 3 + effect
+        for ins, otype, effect in zip(trades.instruction_code,
+                                      trades.option_type_code,
+                                      trades.position_effect_code)
+    ))
+
+
+def leg_delta_columns(trades: TradeTable):
+    """
+    Returns the open interest deltas of every row of trades as four
+    arrays (long calls, short calls, long puts, short puts), by gathering
+    from LEG_SIGN_COLUMNS with the rows' transition codes.
+    """
+    codes = transition_codes(trades)
+    quantity = trades.quantity
+    return tuple(
+        array('q', (signs[code] * q for code, q in zip(codes, quantity)))
+        for signs in LEG_SIGN_COLUMNS
+    )
+
+
+class LedgerRow:
+    """
+    Ledger state after a single trade.
+
+    - trade :: The TradeView for the trade
+    - call_long, call_short, put_long, put_short :: Open interest deltas
+    - cost :: Trade.cost, fixed-point
+    - running_total :: Running P&L of the underlying symbol, fixed-point
+    """
+
+    __slots__ = ('trade', 'call_long', 'call_short', 'put_long',
+                 'put_short', 'cost', 'running_total')
+
+    def __init__(self, trade, deltas, cost, running_total):
+        self.trade = trade
+        (self.call_long, self.call_short,
+         self.put_long, self.put_short) = deltas
+        self.cost = cost
+        self.running_total = running_total
+
+
+class OptionPosition:
+    """
+    Running state for a single option symbol.
+
+    - long_interest, short_interest :: Open contracts on each leg
+    - realized :: Sum of trade costs, fixed-point
+    - rows :: LedgerRows for this option symbol, in time order
+    """
+
+    def __init__(self, option_symbol, expiration_ts):
+        self.option_symbol = option_symbol
+        self.expiration_ts = expiration_ts
+        self.long_interest = 0
+        self.short_interest = 0
+        self.realized = 0
+        self.rows = []
+
+    @property
+    def interest(self):
+        """
+        Net open interest: positive if long, negative if short.
+        """
+        return self.long_interest - self.short_interest
+
+    @property
+    def expiration(self):
+        return ts_to_datetime(self.expiration_ts)
+
+    @property
+    def first_trade(self):
+        return self.rows[0].trade
+
+    @property
+    def last_trade(self):
+        return self.rows[-1].trade
+
+    def is_open(self, today=None):
+        """
+        True if there is open interest in a contract that hasn't expired.
+        """
+        today = today or datetime.date.today()
+        return self.interest != 0 and self.expiration.date() > today
+
+
+class SymbolLedger:
+    """
+    Ledger for a single underlying symbol.
+
+    - rows :: LedgerRows in time order
+    - positions :: OptionPositions keyed by option symbol, in order of
+    first trade
+    - total, call_total, put_total :: Realized P&L, fixed-point
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.rows = []
+        self.positions = {}
+        self.total = 0
+        self.call_total = 0
+        self.put_total = 0
+
+    def add_trades(self, trades: TradeTable):
+        """
+        Applies trades (sorted by time) to the ledger.
+        """
+        costs = trades.costs_fixed()
+        all_deltas = zip(*leg_delta_columns(trades))
+        option_symbols = trades.option_symbols
+        for i, (cost, deltas) in enumerate(zip(costs, all_deltas)):
+            self.total += cost
+            if trades.option_type_code[i] == _CALL:
+                self.call_total += cost
+            else:
+                self.put_total += cost
+            row = LedgerRow(TradeView(trades, i), deltas, cost, self.total)
+            self.rows.append(row)
+
+            option_symbol = option_symbols[trades.option_symbol_id[i]]
+            position = self.positions.get(option_symbol)
+            if position is None:
+                position = OptionPosition(option_symbol,
+                                          trades.expiration_ts[i])
+                self.positions[option_symbol] = position
+            position.long_interest += deltas[0] + deltas[2]
+            position.short_interest += deltas[1] + deltas[3]
+            position.realized += cost
+            position.rows.append(row)
+
+
+class Ledger:
+    """
+    Position ledger over a collection of options trades.
+
+    - symbols :: SymbolLedgers keyed by underlying symbol, sorted by symbol
+    """
+
+    def __init__(self):
+        self.symbols = {}
+
+    @classmethod
+    def from_trades(cls, trades: TradeTable):
+        ledger = cls()
+        for symbol_ledger in iter_symbol_ledgers(trades):
+            ledger.symbols[symbol_ledger.symbol] = symbol_ledger
+        return ledger
+
+    def symbol_ledger(self, symbol):
+        symbol_ledger = self.symbols.get(symbol)
+        if symbol_ledger is None:
+            symbol_ledger = SymbolLedger(symbol)
+            self.symbols[symbol] = symbol_ledger
+        return symbol_ledger
+
+    @property
+    def total(self):
+        return sum(s.total for s in self.symbols.values())
+
+
+def iter_symbol_ledgers(trades: TradeTable):
+    """
+    Yields a SymbolLedger per symbol, sorted by symbol, building each one
+    only when it's needed. Use this instead of Ledger.from_trades to avoid
+    holding every symbol's ledger at once.
+    """
+    for symbol, symbol_trades in trades_by_symbol(trades):
+        symbol_ledger = SymbolLedger(symbol)
+        symbol_ledger.add_trades(symbol_trades)
+        yield symbol_ledger
@@ -0,0 +1,172 @@
+import json
+import time
+import threading
+
+
+"""
+Per-endpoint request metrics for broker APIs.
+
+Every API request records its method, path template (ids replaced by
+placeholders, so requests for different accounts share an endpoint),
+status, latency, response size and retry count. Those are aggregated per
+(method, path template) into latency histograms and totals, which can be
+written to the log or appended to a metrics file (one JSON line per run)
+to follow API latency over time.
+"""
+
+
+# Upper bounds (ms) of the latency histogram buckets. Anything slower goes
+# in a final overflow bucket.
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def path_template(path):
+    """
+    Replaces numeric path segments with {id}:
+    /v1/accounts/123/transactions -> /v1/accounts/{id}/transactions
+    """
+    return '/'.join('{id}' if segment.isdigit() else segment
+                    for segment in path.split('/'))
+
+
+class EndpointStats:
+    """
+    Aggregated metrics for one (method, path template).
+
+    - count :: Requests made
+    - statuses :: Request count by final status code (None when the
+    request failed without a response)
+    - latency_buckets :: Request count per LATENCY_BUCKETS_MS bucket, plus
+    an overflow bucket
+    - latency_total_ms, latency_max_ms :: Latency totals, retries included
+    - bytes_total :: Response body bytes
+    - retries :: Requests that were retried
+    - cache_hits :: Requests answered from the local cache without going
+    to the API. They're not part of any of the above.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statuses = {}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latency_total_ms = 0.0
+        self.latency_max_ms = 0.0
+        self.bytes_total = 0
+        self.retries = 0
+        self.cache_hits = 0
+
+    def add(self, status, latency_ms, nbytes, retries):
+        self.count += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        bucket = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                bucket = i
+                break
+        self.latency_buckets[bucket] += 1
+        self.latency_total_ms += latency_ms
+        self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+        self.bytes_total += nbytes
+        self.retries += retries
+
+    def latency_mean_ms(self):
+        return self.latency_total_ms / self.count if self.count else 0.0
+
+    def latency_quantile_ms(self, q):
+        """
+        Upper bound of the histogram bucket holding quantile q (None if it
+        falls in the overflow bucket).
+        """
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.latency_buckets):
+            seen += n
+            if n and seen >= target:
+                return LATENCY_BUCKETS_MS[i] \
+                    if i < len(LATENCY_BUCKETS_MS) else None
+        return None
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'statuses': {str(k): v for k, v in self.statuses.items()},
+            'latency_buckets_ms': dict(zip(
+                [str(b) for b in LATENCY_BUCKETS_MS] + ['inf'],
+                self.latency_buckets)),
+            'latency_mean_ms': round(self.latency_mean_ms(), 3),
+            'latency_max_ms': round(self.latency_max_ms, 3),
+            'bytes_total': self.bytes_total,
+            'retries': self.retries,
+            'cache_hits': self.cache_hits,
+        }
+
+
+class RequestMetrics:
+    """
+    Thread-safe registry of EndpointStats keyed by (method, path
+    template).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, method, path, status, latency_ms, nbytes=0,
+               retries=0):
+        with self._lock:
+            self._get_stats(method, path).add(status, latency_ms, nbytes,
+                                              retries)
+
+    def record_cache_hit(self, method, path):
+        with self._lock:
+            self._get_stats(method, path).cache_hits += 1
+
+    def _get_stats(self, method, path):
+        key = (method.upper(), path_template(path))
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = EndpointStats()
+        return stats
+
+    def summary_lines(self):
+        lines = []
+        with self._lock:
+            items = sorted(self.endpoints.items())
+        for (method, path), s in items:
+            if not s.count:
+                lines.append(f"{method} {path}: {s.cache_hits} cache hits")
+                continue
+            p50 = s.latency_quantile_ms(0.5)
+            p95 = s.latency_quantile_ms(0.95)
+            statuses = ', '.join(f"{k}={v}" for k, v in s.statuses.items())
+            lines.append(
+                f"{method} {path}: {s.count} requests ({statuses}), "
+                f"mean {s.latency_mean_ms():.1f} ms, "
+                f"p50 <= {p50 or 'inf'} ms, p95 <= {p95 or 'inf'} ms, "
+                f"max {s.latency_max_ms:.1f} ms, {s.bytes_total} bytes, "
+                f"{s.retries} retries, {s.cache_hits} cache hits")
+        return lines
+
+    def log_summary(self, logger):
+        for line in self.summary_lines():
+            logger.info(f"API metrics: {line}")
+
+    def append_to_file(self, path):
+        """
+        Appends one JSON line with this run's metrics to path.
+        """
+        with self._lock:
+            endpoints = {
+                f"{method} {template}": stats.to_dict()
+                for (method, template), stats in sorted(
+                    self.endpoints.items())
+            }
+        with open(path, 'a') as f:
+            f.write(json.dumps({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'endpoints': endpoints,
+            }) + '\n')
+
+
+# Metrics of every request made by this process
+request_metrics = RequestMetrics()
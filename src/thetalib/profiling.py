@@ -0,0 +1,149 @@
+import sys
+import time
+import threading
+import contextlib
+
+
+"""
+Lightweight stage timing for --profile.
+
+Code wraps each stage of a run (auth, HTTP, JSON decoding, parsing, date
+filtering, rendering, ...) in a named span. When profiling is disabled
+(the default) spans do nothing. When enabled, every span records its call
+count, total (inclusive) time and self time, i.e. minus the time spent in
+spans nested inside it on the same thread. report() prints the breakdown.
+
+Spans in worker threads (e.g. concurrent TD requests) are added up
+independently, so their totals can be larger than the wall time of the
+run.
+"""
+
+
+_enabled = False
+_started = None
+_profiler = None
+_stats = {}
+# Time covered by outermost spans on the main thread
+_main_covered = 0.0
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _SpanStats:
+    __slots__ = ('calls', 'total', 'self_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.self_time = 0.0
+
+
+def enable(cprofile=False):
+    """
+    Turns on span timing, and also cProfile if cprofile is True.
+    """
+    global _enabled, _started, _profiler
+    _enabled = True
+    _started = time.perf_counter()
+    if cprofile:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def is_enabled():
+    return _enabled
+
+
+def _record(name, elapsed, child_time):
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = _SpanStats()
+        stats.calls += 1
+        stats.total += elapsed
+        stats.self_time += elapsed - child_time
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Context manager timing the enclosed block as stage name.
+    """
+    if not _enabled:
+        yield
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    # Each stack entry accumulates the time of its direct children
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        child_time = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        elif threading.current_thread() is threading.main_thread():
+            global _main_covered
+            _main_covered += elapsed
+        _record(name, elapsed, child_time)
+
+
+def iter_span(name, iterable):
+    """
+    Returns iterable, timing each step of the iteration as stage name when
+    profiling is enabled. Useful for lazy stages like streaming decodes,
+    whose work is interleaved with that of their consumer.
+    """
+    if not _enabled:
+        return iterable
+    return _iter_span(name, iterable)
+
+
+def _iter_span(name, iterable):
+    it = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+def report(out=None, cprofile_path=None):
+    """
+    Prints the stage breakdown to out (stderr by default), slowest stage
+    first, and dumps cProfile stats to cprofile_path if cProfile was
+    enabled.
+    """
+    out = out or sys.stderr
+    if not _enabled:
+        return
+    if _profiler is not None:
+        _profiler.disable()
+        if cprofile_path:
+            _profiler.dump_stats(cprofile_path)
+    wall = time.perf_counter() - _started
+    with _lock:
+        stats = sorted(_stats.items(), key=lambda el: -el[1].self_time)
+    lines = [
+        f"Profile (wall time {wall * 1000:.1f} ms):",
+        f"  {'stage':<14} {'calls':>8} {'total ms':>11} {'self ms':>11}"
+        f" {'self %':>7}",
+    ]
+    for name, s in stats:
+        lines.append(f"  {name:<14} {s.calls:>8} {s.total * 1000:>11.1f} "
+                     f"{s.self_time * 1000:>11.1f} "
+                     f"{100 * s.self_time / wall:>6.1f}%")
+    # Whatever no span covered: imports, interpreter startup/shutdown work
+    # in between stages, etc.
+    other = max(0.0, wall - _main_covered)
+    lines.append(f"  {'(other)':<14} {'':>8} {'':>11} {other * 1000:>11.1f} "
+                 f"{100 * other / wall:>6.1f}%")
+    if _profiler is not None and cprofile_path:
+        lines.append(f"cProfile stats written to {cprofile_path}")
+    print('\n'.join(lines), file=out)
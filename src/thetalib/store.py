@@ -0,0 +1,177 @@
+import os
+import sqlite3
+import datetime
+from collections import namedtuple
+
+from thetalib.config import get_user_data_dir
+
+
+"""
+Sync bookkeeping for broker transactions, in a SQLite database, so that
+brokers only need to ask their API for transactions newer than the last
+sync. Every synced transaction's (provider, account_id, transaction_id)
+is recorded with its date, along with per-account sync state. The raw
+transactions themselves are kept in a thetalib.archive archive.
+"""
+
+
+# How far an account has been synced: through synced_through (an ISO-8601
+# date, the last day covered by a sync), as of synced_at (epoch seconds).
+SyncState = namedtuple('SyncState', ['synced_through', 'synced_at'])
+
+# How far back an account's history has been synced: from synced_from (an
+# ISO-8601 date) onwards, and whether that's all of it.
+HistoryState = namedtuple('HistoryState', ['synced_from', 'complete'])
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transaction_ids (
+    provider TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    transaction_id TEXT NOT NULL,
+    transaction_date TEXT NOT NULL,
+    PRIMARY KEY (provider, account_id, transaction_id)
+);
+CREATE INDEX IF NOT EXISTS transaction_ids_by_date
+    ON transaction_ids (provider, account_id, transaction_date);
+CREATE TABLE IF NOT EXISTS sync_state (
+    provider TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    synced_through TEXT NOT NULL,
+    synced_at INTEGER NOT NULL,
+    PRIMARY KEY (provider, account_id)
+);
+CREATE TABLE IF NOT EXISTS history_state (
+    provider TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    synced_from TEXT NOT NULL,
+    complete INTEGER NOT NULL,
+    PRIMARY KEY (provider, account_id)
+);
+"""
+
+
+class TransactionStore:
+    """
+    Persistent record of synced transactions and per-account sync state.
+
+    - path :: Location of the SQLite database. Defaults to
+    transactions.sqlite3 in the user data dir.
+    """
+
+    @staticmethod
+    def _get_store_path():
+        return os.path.join(get_user_data_dir(), 'transactions.sqlite3')
+
+    def __init__(self, path=None):
+        self._path = path or self._get_store_path()
+        self._conn = sqlite3.connect(self._path, timeout=30)
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def get_sync_state(self, provider, account_id):
+        """
+        Returns the SyncState for the given account, or None if it has
+        never been synced.
+        """
+        row = self._conn.execute(
+            "SELECT synced_through, synced_at "
+            "FROM sync_state WHERE provider = ? AND account_id = ?",
+            (provider, str(account_id)),
+        ).fetchone()
+        if row is None:
+            return None
+        return SyncState(*row)
+
+    def get_history_state(self, provider, account_id):
+        """
+        Returns the HistoryState for the given account, or None if it isn't
+        known (never synced, or synced before history was tracked).
+        """
+        row = self._conn.execute(
+            "SELECT synced_from, complete FROM history_state "
+            "WHERE provider = ? AND account_id = ?",
+            (provider, str(account_id)),
+        ).fetchone()
+        if row is None:
+            return None
+        return HistoryState(row[0], bool(row[1]))
+
+    def set_history_state(self, provider, account_id, synced_from,
+                          complete):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO history_state "
+                "(provider, account_id, synced_from, complete) "
+                "VALUES (?, ?, ?, ?)",
+                (provider, str(account_id), synced_from, int(complete)),
+            )
+
+    def get_transaction_ids(self, provider, account_id):
+        """
+        Returns the ids of all synced transactions of the given account,
+        oldest first.
+        """
+        rows = self._conn.execute(
+            "SELECT transaction_id FROM transaction_ids "
+            "WHERE provider = ? AND account_id = ? "
+            "ORDER BY transaction_date, transaction_id",
+            (provider, str(account_id)),
+        )
+        return [tid for (tid,) in rows]
+
+    def forget_account(self, provider, account_id):
+        """
+        Drops everything known about the given account, so that its next
+        sync starts from scratch.
+        """
+        params = (provider, str(account_id))
+        with self._conn:
+            for table in ('transaction_ids', 'sync_state', 'history_state'):
+                self._conn.execute(
+                    f"DELETE FROM {table} "
+                    "WHERE provider = ? AND account_id = ?", params)
+
+    def merge_transactions(self, provider, account_id, transactions,
+                           synced_through):
+        """
+        Records transactions of the given account as synced, and that
+        everything up to synced_through (an ISO-8601 date) has been
+        synced. transactions is an iterable of (transaction_id,
+        transaction_date) tuples, where transaction_date is an ISO-8601
+        string (so that it sorts chronologically). It may be empty: an
+        empty window has been synced too. The sync state never moves
+        back, so syncing older history doesn't affect it.
+
+        Returns the number of transactions merged.
+        """
+        account_id = str(account_id)
+        rows = [
+            (provider, account_id, str(tid), tdate)
+            for tid, tdate in transactions
+        ]
+        now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO transaction_ids "
+                "(provider, account_id, transaction_id, transaction_date) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            row = self._conn.execute(
+                "SELECT synced_through FROM sync_state "
+                "WHERE provider = ? AND account_id = ?",
+                (provider, account_id),
+            ).fetchone()
+            if row is not None:
+                synced_through = max(synced_through, row[0])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state "
+                "(provider, account_id, synced_through, synced_at) "
+                "VALUES (?, ?, ?, ?)",
+                (provider, account_id, synced_through, now),
+            )
+        return len(rows)
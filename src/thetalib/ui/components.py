@@ -1,63 +1,51 @@
-import datetime
-from collections import defaultdict
+import sys
+import time
 import typing
+import datetime
 
 from colorama import Fore, Style
 from tabulate import tabulate
 
-from thetalib.brokers import Trade, Instruction, OptionType, PositionEffect
+from thetalib.aggregate import profit_totals
+from thetalib.brokers import TradeTable
+from thetalib.brokers.base import OptionType, PositionEffect, from_fixed
+from thetalib.ledger import (
+    Ledger,
+    SymbolLedger,
+    iter_symbol_ledgers,
+    trades_by_symbol,
+)
 from thetalib.numfmt import deltastr, pdeltastr
 
 
+def _money(fixed):
+    return f"{from_fixed(fixed):.2f}"
+
+
 def _get_trade_grid(
-        symbol: str, trades: list[Trade]) -> typing.Tuple[str, str]:
+        symbol_ledger: SymbolLedger) -> typing.Tuple[str, str]:
 
     rows = []
-    total_profits = 0
-    for trade in trades:
-        call_long_interest_delta = 0
-        call_short_interest_delta = 0
-        put_long_interest_delta = 0
-        put_short_interest_delta = 0
-        pos = (trade.instruction, trade.option_type, trade.position_effect)
-        if pos == (Instruction.BUY, OptionType.CALL, PositionEffect.OPEN):
-            call_long_interest_delta = trade.quantity
-        elif pos == (Instruction.BUY, OptionType.CALL, PositionEffect.CLOSE):
-            call_short_interest_delta = -trade.quantity
-        elif pos == (Instruction.BUY, OptionType.PUT, PositionEffect.OPEN):
-            put_long_interest_delta = trade.quantity
-        elif pos == (Instruction.BUY, OptionType.PUT, PositionEffect.CLOSE):
-            put_short_interest_delta = -trade.quantity
-        elif pos == (Instruction.SELL, OptionType.CALL, PositionEffect.OPEN):
-            call_short_interest_delta = trade.quantity
-        elif pos == (Instruction.SELL, OptionType.CALL, PositionEffect.CLOSE):
-            call_long_interest_delta = -trade.quantity
-        elif pos == (Instruction.SELL, OptionType.PUT, PositionEffect.OPEN):
-            put_short_interest_delta = trade.quantity
-        elif pos == (Instruction.SELL, OptionType.PUT, PositionEffect.CLOSE):
-            put_long_interest_delta = -trade.quantity
-
-        total_profits_delta = trade.price * trade.quantity * 100
-        if trade.instruction == Instruction.BUY:
-            total_profits_delta *= -1
-        total_profits += total_profits_delta
+    for row in symbol_ledger.rows:
+        trade = row.trade
+        profits_delta = from_fixed(row.cost)
         if trade.option_type == OptionType.CALL:
-            call_profits_delta = total_profits_delta
+            call_profits_delta = profits_delta
             put_profits_delta = 0
         else:
             call_profits_delta = 0
-            put_profits_delta = total_profits_delta
+            put_profits_delta = profits_delta
 
         rows.append((
             str(trade),
-            f"{pdeltastr(call_long_interest_delta)}",
-            f"{pdeltastr(call_short_interest_delta)}",
-            f"{pdeltastr(put_long_interest_delta)}",
-            f"{pdeltastr(put_short_interest_delta)}",
+            f"{pdeltastr(row.call_long)}",
+            f"{pdeltastr(row.call_short)}",
+            f"{pdeltastr(row.put_long)}",
+            f"{pdeltastr(row.put_short)}",
             f"{pdeltastr(call_profits_delta, include_sign=False, currency=True)}",
             f"{pdeltastr(put_profits_delta, include_sign=False, currency=True)}",
-            f"{total_profits}"
-            f"{pdeltastr(total_profits_delta, include_sign=False, currency=True)}",
+            f"{_money(row.running_total)}"
+            f"{pdeltastr(profits_delta, include_sign=False, currency=True)}",
         ))
 
     headers = (
@@ -71,52 +59,32 @@ def _get_trade_grid(
         "Total Profits",
     )
     table = tabulate(rows, headers=headers, tablefmt="orgtbl")
-    return table, total_profits
+    return table, from_fixed(symbol_ledger.total)
 
 
 def _get_trade_sequence(
-        symbol: str, trades: list[Trade]) -> str:
-    trades_by_option = defaultdict(list)
-
-    for trade in trades:
-        trades_by_option[trade.option_symbol].append(trade)
-
+        symbol_ledger: SymbolLedger) -> str:
     rows = []
-    total_profit = 0
-    for option_symbol, otrades in trades_by_option.items():
+    for option_symbol, position in symbol_ledger.positions.items():
         trade_sequence = []
-        profit = 0
-        interest = 0
-        option_expiration = otrades[0].option_expiration
-        for trade in otrades:
-            profit += trade.cost
-            pos = (trade.instruction, trade.position_effect)
-            if pos == (Instruction.BUY, PositionEffect.OPEN):
-                interest += trade.quantity
-            elif pos == (Instruction.BUY, PositionEffect.CLOSE):
-                interest += trade.quantity
-            elif pos == (Instruction.SELL, PositionEffect.OPEN):
-                interest -= trade.quantity
-            elif pos == (Instruction.SELL, PositionEffect.CLOSE):
-                interest -= trade.quantity
-
+        for row in position.rows:
+            trade = row.trade
             if trade.position_effect == PositionEffect.OPEN:
                 effect = Fore.RED
             else:
                 effect = Fore.GREEN
             trade_sequence.append(
                 f"{effect}{trade.ieffect} "
-                f"{trade.quantity}x{trade.price}={trade.cost}"
+                f"{trade.quantity}x{trade.price}={_money(row.cost)}"
                 f"{Style.RESET_ALL}"
             )
 
-        total_profit += profit
         seq = ' -> '.join(trade_sequence)
-        profit_s = deltastr(profit, currency=True)
+        profit_s = deltastr(from_fixed(position.realized), currency=True)
         interest_s = ''
-        if interest != 0:
-            if option_expiration.date() > datetime.date.today():
-                interest_s = f", open interest={deltastr(interest)}"
+        if position.interest != 0:
+            if position.is_open():
+                interest_s = f", open interest={deltastr(position.interest)}"
                 profit_s = f"{Style.DIM}{profit_s}{Style.RESET_ALL}"
                 seq += f' -> {Style.BRIGHT}...{Style.RESET_ALL}'
             else:
@@ -125,32 +93,110 @@ def _get_trade_sequence(
         rows.append(f"{option_symbol} [profit={profit_s}{interest_s}] :: "
                     f"{seq}")
 
-    summary = f"Total profit: {deltastr(total_profit, currency=True)}"
+    summary = (f"Total profit: "
+               f"{deltastr(from_fixed(symbol_ledger.total), currency=True)}")
     return summary, '\n'.join(rows)
 
 
-def trade_grid(options_trades):
-    by_symbol = defaultdict(list)
-    for t in options_trades:
-        by_symbol[t.symbol].append(t)
-    profits_by_symbol = dict()
-    for symbol, trades in sorted(by_symbol.items(), key=lambda el: el[0]):
-        print(f"{Style.BRIGHT}{Fore.LIGHTMAGENTA_EX}{symbol}"
-              f"{Style.RESET_ALL}")
-        trades = sorted(trades, key=lambda t: t.transaction_datetime)
-        full_table, profits = _get_trade_grid(symbol, trades)
-        csummary, condensed_table = _get_trade_sequence(symbol, trades)
-        print(f"{Style.BRIGHT}Trade grid:{Style.RESET_ALL}")
-        print(full_table)
-        print(f"\n{Style.BRIGHT}Trade sequences:{Style.RESET_ALL}")
-        print(condensed_table)
-        profits_by_symbol[symbol] = profits
-        print()
-
-    print(f"---\n{Style.BRIGHT}Summary{Style.RESET_ALL}")
-    for symbol, profits in profits_by_symbol.items():
-        print(f"{Style.BRIGHT}{symbol:>5}:{Style.RESET_ALL} "
-              f"{deltastr(profits, currency=True)}")
-    total_profits_sum = sum(profits_by_symbol.values())
-    print(f"{Style.BRIGHT}Total: "
-          f"{deltastr(total_profits_sum, currency=True)}{Style.RESET_ALL}")
+def _render_symbol(symbol_ledger: SymbolLedger) -> str:
+    full_table, _ = _get_trade_grid(symbol_ledger)
+    csummary, condensed_table = _get_trade_sequence(symbol_ledger)
+    return (f"{Style.BRIGHT}{Fore.LIGHTMAGENTA_EX}{symbol_ledger.symbol}"
+            f"{Style.RESET_ALL}\n"
+            f"{Style.BRIGHT}Trade grid:{Style.RESET_ALL}\n"
+            f"{full_table}\n"
+            f"\n{Style.BRIGHT}Trade sequences:{Style.RESET_ALL}\n"
+            f"{condensed_table}\n"
+            f"\n")
+
+
+def _render_summary(profits_by_symbol) -> str:
+    lines = [f"---\n{Style.BRIGHT}Summary{Style.RESET_ALL}"]
+    for symbol, profits in profits_by_symbol:
+        lines.append(f"{Style.BRIGHT}{symbol:>5}:{Style.RESET_ALL} "
+                     f"{deltastr(profits, currency=True)}")
+    total_profits_sum = sum(profits for _, profits in profits_by_symbol)
+    lines.append(f"{Style.BRIGHT}Total: "
+                 f"{deltastr(total_profits_sum, currency=True)}"
+                 f"{Style.RESET_ALL}")
+    return '\n'.join(lines) + '\n'
+
+
+def _render_months(options_trades: TradeTable) -> str:
+    lines = [f"---\n{Style.BRIGHT}By month (UTC){Style.RESET_ALL}"]
+    for month, profits in profit_totals(options_trades, 'month').items():
+        lines.append(f"{Style.BRIGHT}{month}:{Style.RESET_ALL} "
+                     f"{deltastr(from_fixed(profits), currency=True)}")
+    return '\n'.join(lines) + '\n'
+
+
+def iter_trade_grid(options_trades: TradeTable, by_month=False):
+    """
+    Yields the options report chunk by chunk: one chunk per symbol,
+    followed by the summary. Each symbol's ledger is built just before it
+    is rendered and dropped afterwards, and the summary comes from the
+    running per-symbol totals. Those are summed by the ledger while it
+    walks the rows it renders anyway, so there's no separate aggregation
+    pass over the trades.
+
+    With by_month, the summary is followed by the P&L of every month,
+    which the ledger doesn't track (see thetalib.aggregate).
+    """
+    profits_by_symbol = []
+    for symbol_ledger in iter_symbol_ledgers(options_trades):
+        yield _render_symbol(symbol_ledger)
+        profits_by_symbol.append((symbol_ledger.symbol,
+                                  from_fixed(symbol_ledger.total)))
+    yield _render_summary(profits_by_symbol)
+    if by_month:
+        yield _render_months(options_trades)
+
+
+def trade_grid(options_trades: TradeTable, out=None, by_month=False):
+    """
+    Writes the options report to out (stdout by default), flushing after
+    every symbol so output shows up as soon as it's ready.
+    """
+    out = out or sys.stdout
+    for chunk in iter_trade_grid(options_trades, by_month):
+        out.write(chunk)
+        out.flush()
+
+
+def _ledger_profits(ledger: Ledger):
+    return [(symbol, from_fixed(symbol_ledger.total))
+            for symbol, symbol_ledger in sorted(ledger.symbols.items())]
+
+
+def watch_trade_grid(options_trades: TradeTable, poll, interval, out=None):
+    """
+    Writes the options report, then keeps polling for new trades every
+    interval seconds until interrupted. poll() returns a TradeTable of the
+    options trades that are new since the last call. New trades are
+    applied to the ledger kept from the previous round, and only the
+    symbols they touched are written again, followed by a fresh summary.
+    """
+    out = out or sys.stdout
+    ledger = Ledger.from_trades(options_trades)
+    for symbol_ledger in ledger.symbols.values():
+        out.write(_render_symbol(symbol_ledger))
+        out.flush()
+    out.write(_render_summary(_ledger_profits(ledger)))
+    out.flush()
+
+    while True:
+        time.sleep(interval)
+        new_trades = poll()
+        if not len(new_trades):
+            continue
+        changed = []
+        for symbol, symbol_trades in trades_by_symbol(new_trades):
+            symbol_ledger = ledger.symbol_ledger(symbol)
+            symbol_ledger.add_trades(symbol_trades)
+            changed.append(symbol_ledger)
+        out.write(f"\n{Style.BRIGHT}=== {datetime.datetime.now():%H:%M:%S}: "
+                  f"{len(new_trades)} new trade(s) ==={Style.RESET_ALL}\n\n")
+        for symbol_ledger in changed:
+            out.write(_render_symbol(symbol_ledger))
+        out.write(_render_summary(_ledger_profits(ledger)))
+        out.flush()
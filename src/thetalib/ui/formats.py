@@ -0,0 +1,182 @@
+import io
+import csv
+import json
+
+from thetalib.aggregate import profit_totals
+from thetalib.brokers import TradeTable
+from thetalib.brokers.base import from_fixed
+from thetalib.ledger import iter_symbol_ledgers
+
+
+"""
+Machine-readable options reports.
+
+These render the same ledger as trade_grid, but without colors or table
+layout. Every format is a generator of output chunks (one per symbol), so
+consumers can start reading right away. Money values are exact decimal
+strings.
+
+Records:
+
+- trade :: One per trade, with open interest deltas and the running P&L
+  of its symbol
+- symbol_total :: Realized P&L of a symbol, after its trades
+- month_total :: Realized P&L of a month ("YYYY-MM", UTC), only when
+  asked for, after all symbols
+- total :: Realized P&L across all symbols, last
+"""
+
+
+TRADE_FIELDS = (
+    'symbol',
+    'option_symbol',
+    'transaction_datetime',
+    'instruction',
+    'option_type',
+    'position_effect',
+    'quantity',
+    'price',
+    'strike',
+    'expiration',
+    'fees',
+    'cost',
+    'long_calls',
+    'short_calls',
+    'long_puts',
+    'short_puts',
+    'running_total',
+)
+
+CSV_FIELDS = ('record',) + TRADE_FIELDS + ('profit',)
+
+# With month_total records
+CSV_MONTH_FIELDS = CSV_FIELDS + ('month',)
+
+
+def _money(fixed):
+    value = from_fixed(fixed)
+    return None if value is None else str(value)
+
+
+def _optional_str(value):
+    return None if value is None else str(value)
+
+
+def _trade_record(row):
+    trade = row.trade
+    expiration = trade.option_expiration
+    return {
+        'record': 'trade',
+        'symbol': trade.symbol,
+        'option_symbol': trade.option_symbol,
+        'transaction_datetime': trade.transaction_datetime.isoformat(),
+        'instruction': str(trade.instruction),
+        'option_type': _optional_str(trade.option_type),
+        'position_effect': _optional_str(trade.position_effect),
+        'quantity': trade.quantity,
+        'price': str(trade.price),
+        'strike': _optional_str(trade.strike),
+        'expiration': expiration.date().isoformat() if expiration else None,
+        'fees': str(trade.fees_and_commissions),
+        'cost': _money(row.cost),
+        'long_calls': row.call_long,
+        'short_calls': row.call_short,
+        'long_puts': row.put_long,
+        'short_puts': row.put_short,
+        'running_total': _money(row.running_total),
+    }
+
+
+def iter_records(options_trades: TradeTable, by_month=False):
+    """
+    Yields lists of report records (dicts), one list per symbol, then the
+    month_total records if by_month, and a final list holding the total
+    record.
+    """
+    total = 0
+    for symbol_ledger in iter_symbol_ledgers(options_trades):
+        records = [_trade_record(row) for row in symbol_ledger.rows]
+        records.append({
+            'record': 'symbol_total',
+            'symbol': symbol_ledger.symbol,
+            'profit': _money(symbol_ledger.total),
+        })
+        total += symbol_ledger.total
+        yield records
+    if by_month:
+        yield [
+            {'record': 'month_total', 'month': month,
+             'profit': _money(profits)}
+            for month, profits in profit_totals(options_trades,
+                                                'month').items()
+        ]
+    yield [{'record': 'total', 'profit': _money(total)}]
+
+
+def iter_ndjson(options_trades: TradeTable, by_month=False):
+    for records in iter_records(options_trades, by_month):
+        yield ''.join(json.dumps(r) + '\n' for r in records)
+
+
+def iter_csv(options_trades: TradeTable, by_month=False):
+    buf = io.StringIO()
+    writer = csv.DictWriter(
+        buf, fieldnames=CSV_MONTH_FIELDS if by_month else CSV_FIELDS,
+        restval='')
+    writer.writeheader()
+    for records in iter_records(options_trades, by_month):
+        writer.writerows(records)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def iter_json(options_trades: TradeTable, by_month=False):
+    """
+    Yields a single JSON document:
+
+    {"trades": [...], "symbols": {symbol: profit, ...}, "total": profit}
+
+    With by_month, there's also "months": {month: profit, ...} before
+    "total".
+    """
+    symbol_totals = {}
+    month_totals = {}
+    total = None
+    first = True
+    yield '{"trades": ['
+    for records in iter_records(options_trades, by_month):
+        trades = []
+        for record in records:
+            kind = record.pop('record')
+            if kind == 'trade':
+                trades.append(json.dumps(record))
+            elif kind == 'symbol_total':
+                symbol_totals[record['symbol']] = record['profit']
+            elif kind == 'month_total':
+                month_totals[record['month']] = record['profit']
+            else:
+                total = record['profit']
+        if trades:
+            yield ('' if first else ',\n') + ',\n'.join(trades)
+            first = False
+    months = f'"months": {json.dumps(month_totals)},\n' if by_month else ''
+    yield (f'],\n"symbols": {json.dumps(symbol_totals)},\n{months}'
+           f'"total": {json.dumps(total)}}}\n')
+
+
+FORMATS = {
+    'ndjson': iter_ndjson,
+    'csv': iter_csv,
+    'json': iter_json,
+}
+
+
+def write_report(options_trades: TradeTable, fmt, out, by_month=False):
+    """
+    Writes the options report in one of FORMATS to out, flushing after
+    every chunk.
+    """
+    for chunk in FORMATS[fmt](options_trades, by_month):
+        out.write(chunk)
+        out.flush()